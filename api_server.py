@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import logging
+import uuid
+import weakref
+
+from aiohttp import web
+
+from chatbot_logic import warm_up_response_pool
+import conversation
+import metrics
+from resources import readiness, warm_up
+
+
+class ChatbotAPI:
+    """
+    Headless HTTP/JSON interface to the ordering conversation, for kiosk and drive-thru clients and load tests.
+
+    POST /messages                  {"session_id": optional, "message": "..."} -> {"session_id", "response", "order"}
+    GET  /sessions/{session_id}     -> {"session_id", "order"}
+    GET  /health                    -> {"ready", "resources"}
+    GET  /metrics                   -> per-stage latency metrics in the Prometheus text format
+
+    A message without a session_id (or with an unknown one) starts a new session. Message handling runs
+    in a thread pool since spaCy and GPT-2 are blocking, and messages for the same session are handled one at a time.
+    """
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else conversation.InMemorySessionStore()
+        # Locks disappear on their own once no request for the session holds or waits on them
+        self._session_locks = weakref.WeakValueDictionary()
+
+    def routes(self):
+        return [
+            web.post("/messages", self.post_message),
+            web.get("/sessions/{session_id}", self.get_session),
+            web.get("/health", self.health),
+            web.get("/metrics", self.metrics),
+        ]
+
+    def _lock_for(self, session_id):
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        return lock
+
+    async def post_message(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Request body must be JSON")
+
+        message = body.get("message") if isinstance(body, dict) else None
+        if not isinstance(message, str) or not message.strip():
+            raise web.HTTPBadRequest(text="'message' must be a non-empty string")
+
+        session_id = body.get("session_id") or uuid.uuid4().hex
+        if not isinstance(session_id, str):
+            raise web.HTTPBadRequest(text="'session_id' must be a string")
+        async with self._lock_for(session_id):
+            session = self.store.get(session_id) or self.store.create(session_id)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, conversation.handle_message, session, message)
+            self.store.save(session)
+
+        return web.json_response({
+            "session_id": session.session_id,
+            "response": response,
+            "order": session.order.to_dict(),
+        })
+
+    async def get_session(self, request):
+        session = self.store.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="Unknown session")
+        return web.json_response(session.to_dict())
+
+    async def health(self, request):
+        states = readiness()
+        return web.json_response({
+            "ready": all(state == "ready" for state in states.values()),
+            "resources": states,
+        })
+
+
+    async def metrics(self, request):
+        return web.Response(text=metrics.expose(), content_type="text/plain", charset="utf-8")
+
+
+def create_app(store=None):
+    app = web.Application()
+    app.add_routes(ChatbotAPI(store).routes())
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the Taco Bell chatbot over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--no-warm-up", action="store_true", help="load the menu and models on first request instead of at startup")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.no_warm_up:
+        warm_up()
+        warm_up_response_pool()
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -1,15 +1,48 @@
 import streamlit as st
-from chatbot_logic import parse_user_input, simplify_sentence, remove_context, detect_intent, apply_modifications, get_price, get_description, show_tacos, show_burritos, show_nachos, show_bowls, show_sides, show_drinks, show_sauces, show_dairy, show_gluten_free, show_menu, show_categorized_menu, generate_conversational_response
+from chat_history import ChatHistory, SQLiteChatStore
+from chatbot_logic import show_categorized_menu, current_menu, warm_up_response_pool
+import conversation
+import metrics
+from metrics import MessageTimer, start_metrics_server
+from resources import warm_up, readiness
 import logging
-from collections import defaultdict
+import os
 import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
+# Number of past exchanges shown at a time on the order page, and added by "Load older messages"
+CHAT_WINDOW_SIZE = 20
+
+# Each session keeps at most this many recent exchanges and bytes of chat in memory, older ones go to the history store
+CHAT_HISTORY_MAX_TURNS = int(os.getenv("CHAT_HISTORY_MAX_TURNS") or CHAT_WINDOW_SIZE)
+CHAT_HISTORY_BUDGET = int(os.getenv("CHAT_HISTORY_BUDGET_KB") or 256) * 1024
+
 # Set page layout and theme
 st.set_page_config(page_title="Taco Bell Chatbot", layout="wide")
 
+# Start loading the menu and models in the background once per server process,
+# unless disabled with WARM_UP_ON_BOOT=0 (resources then load on first use).
+# Per-stage latency metrics are served on localhost:METRICS_PORT/metrics when it's set
+@st.cache_resource
+def start_warm_up():
+    if os.getenv("WARM_UP_ON_BOOT", "1") != "0":
+        warm_up()
+        warm_up_response_pool()
+    if os.getenv("METRICS_PORT"):
+        start_metrics_server(int(os.getenv("METRICS_PORT")))
+    return True
+
+# One history store per server process, shared by its sessions
+@st.cache_resource
+def chat_history_store():
+    path = os.getenv("CHAT_HISTORY_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_history.sqlite3")
+    metrics.chat_history_budget_bytes.set(CHAT_HISTORY_BUDGET)
+    return SQLiteChatStore(path, retention=float(os.getenv("CHAT_HISTORY_RETENTION_HOURS") or 24) * 3600)
+
+start_warm_up()
+
 # Custom CSS for styling
 def add_custom_styles():
     st.markdown(
@@ -117,6 +150,11 @@ def add_custom_styles():
         .menu-item p {
             font-size: 16px;
         }
+        .menu-grid {
+            display: grid;
+            grid-template-columns: repeat(4, 1fr); /* 4 cards per row */
+            column-gap: 1rem;
+        }
 
         /* Sticky Navbar */
         .navbar-container {
@@ -248,14 +286,21 @@ def add_custom_styles():
     )
 
 # Initialize session state if not already done
-if 'order' not in st.session_state:
-    st.session_state.order = defaultdict(int)  # item name: quantity
-if 'total' not in st.session_state:
-    st.session_state.total = 0.0  # total $ amount
+if 'conversation' not in st.session_state:
+    st.session_state.conversation = conversation.ConversationSession()  # order and other conversation state
 if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []  # Stores (user_message, bot_response) tuples
+    # (user_message, bot_response) exchanges, the latest in memory along with their rendered bubbles
+    st.session_state.chat_history = ChatHistory(
+        st.session_state.conversation.session_id,
+        chat_history_store(),
+        lambda user_message, bot_response: chat_bubble(user_message, "user-message") + chat_bubble(bot_response, "bot-message"),
+        max_turns=CHAT_HISTORY_MAX_TURNS,
+        budget=CHAT_HISTORY_BUDGET,
+    )
 if "current_page" not in st.session_state:
     st.session_state.current_page = "order"  # Default page
+if 'chat_window' not in st.session_state:
+    st.session_state.chat_window = CHAT_WINDOW_SIZE  # Number of past exchanges shown on the order page
 
 # Navbar for navigation
 def navbar():
@@ -268,9 +313,16 @@ def navbar():
         if st.button("Help"):
             st.session_state.current_page = "help"
 
+        # Let the user know while the chatbot is still loading its models
+        states = readiness()
+        if "failed" in states.values():
+            st.markdown("<p>Some chatbot features are unavailable right now.</p>", unsafe_allow_html=True)
+        elif any(state != "ready" for state in states.values()):
+            st.markdown("<p>Chatbot is warming up...</p>", unsafe_allow_html=True)
+
 # Function to display chat history in a chat-like format
 def display_chat_history():
-    for user_message, bot_response in reversed(st.session_state.chat_history):
+    for user_message, bot_response in reversed(st.session_state.chat_history.recent()):
         if len(st.session_state.chat_history) > 1:
             st.write("\n\n\n\n")
 
@@ -279,132 +331,34 @@ def display_chat_history():
         # Display the chatbot response
         st.markdown(f"**Chatbot:** {bot_response}")
 
-# Update order
-def update_order(commands):
-    responses = []
-
-    for command in commands:
-        intent, item, quantity, modifications, size = command.values()
-
-        # Check if the item is recognized
-        if not item:
-            responses.append("An item in the user's order could not be recognized.")
-            continue    # Skip to the next command
-
-        item_name = item["name"]    # Extract item name
-        have_or_has = "have" if quantity > 1 else "has"
-
-        # Add size information to the item name if size is provided
-        if size:
-            item_name = f"{size.capitalize()} {item_name}"
-
-        # Add modifications if needed
-        if modifications:
-            modification_message = apply_modifications(modifications)
-            item_name = item_name + f" ({modification_message})"
-
-        # Handle the 'add_item' intent
-        if intent == "add_item":
-            st.session_state.order[item_name] += quantity  # Update the order with the added item quantity
-            st.session_state.total += item["price"] * quantity  # Update the total price
-            # Generate response message about the added items
-            responses.append(f"{quantity} {item_name + "s" if quantity > 1 else item_name} {have_or_has} been added to your order.")
-
-        elif intent == "remove_item":
-            amount = min(quantity, st.session_state.order[item_name])  # Ensure not removing more than what's in the order
-            st.session_state.order[item_name] -= amount  # Update the order after removal
-            # If the item count is zero, remove it from the order entirely
-            if st.session_state.order[item_name] == 0:
-                st.session_state.order.pop(item_name)
-            st.session_state.total -= item["price"] * amount  # Update the total price after removal
-            # Generate response message about the removed items
-            responses.append(f"{amount} {item_name + "s" if quantity > 1 else item_name} {have_or_has} been removed from your order.")
-    
-    # Return all the responses as a single string, joining them with a space
-    return " ".join(responses)
-
-def process_user_input(user_input):
-    commands = parse_user_input(user_input)
-    response = update_order(commands)
-    return response
-
-def print_order():
-    order = []
-
-    for item_name, quantity in st.session_state.order.items():
-        order.append(f"{quantity} x {item_name}")
-
-    return "\n\n".join(order)
-
-
-# Chatbot logic
-def handle_message(user_input):
-    simplified_input = user_input.replace("Let's", "").strip()
-    simplified_input = simplify_sentence(simplified_input)
-    intent = detect_intent(simplified_input)
-
-    if intent == 'add_item' or intent == 'remove_item':
-        context = process_user_input(simplified_input)
-        response = remove_context(generate_conversational_response(context))
-    
-    elif intent == "get_price":
-        response = get_price(simplified_input)
-    elif intent == "get_description":
-        description = get_description(simplified_input)
-        if description:
-            response = description
-        else:
-            context = "The chatbot couldn't find what the user was looking for."
-            response = remove_context(generate_conversational_response(context))
-    elif intent == 'get_tacos':
-        response = show_tacos()
-    elif intent == 'get_burritos':
-        response = show_burritos()
-    elif intent == 'get_nachos':
-        response = show_nachos()
-    elif intent == 'get_bowls':
-        response = show_bowls()
-    elif intent == 'get_sides':
-        response = show_sides()
-    elif intent == 'get_drinks':
-        response = show_drinks()
-    elif intent == 'get_sauces':
-        response = show_sauces()
-    elif intent == 'get_dairy':
-        response = show_dairy()
-    elif intent == 'get_gluten_free':
-        response = show_gluten_free()
-    elif intent == 'get_menu':
-        response = show_menu()
-    
-    elif intent == 'ask_question':
-        context = f"The user asked: '{user_input}'"
-        response = remove_context(generate_conversational_response(context))
-
-    elif intent == "view_order":
-        if st.session_state.order:
-            response = f"Your current order is \n\n{print_order()}\n\nand your total is ${st.session_state.total:.2f}."
-        else:
-            context = "The user asked to see their current order, but the user has not ordered anything."
-            response = remove_context(generate_conversational_response(context))
-    
-    elif intent == 'complete_order':
-        context = f"The user has finished their order. The final order is {print_order()}."
-        response = remove_context(generate_conversational_response(context))
+# Handle a message for this Streamlit session, streaming model responses unless STREAM_RESPONSES=0
+def handle_message(user_input, timer):
+    session = st.session_state.conversation
+    final_order = conversation.print_order(session)    # Completing the order clears the cart
+    response = conversation.handle_message(session, user_input, stream=os.getenv("STREAM_RESPONSES", "1") != "0", timer=timer)
+    # The cart is kept if the order couldn't be placed
+    if session.last_intent == 'complete_order' and final_order and not session.order:
         st.write("\n\n")
-        st.write(f"Final order: {print_order()}")
-        logging.info(f"logging Final order: {st.session_state.order}")
+        st.write(f"Final order: {final_order}")
+    return response
 
-    elif intent == 'cancel_order':
-        st.session_state.order.clear()
-        context = "The user cancelled the entire order."
-        response = remove_context(generate_conversational_response(context))
+# HTML for one chat bubble. Newlines become <br> so a multi-line response can't end the HTML block early
+def chat_bubble(message, css_class):
+    message = message.replace("\n", "<br>")
+    return f'<div><div class="chat-bubble {css_class}">{message}</div></div>'
 
-    else:
-        context = "The chatbot couldn't understand the user's question."
-        response = remove_context(generate_conversational_response(context))
+# Render past exchanges as a single HTML block. Bubbles of recent exchanges are built once and kept in the
+# session's history, so a rerun only formats new messages, and only the latest chat_window exchanges are sent to
+# the browser. Older exchanges are only read back from the history store once the user loads them
+def render_chat_history():
+    history = st.session_state.chat_history
+    if len(history) > st.session_state.chat_window:
+        if st.button("Load older messages"):
+            st.session_state.chat_window += CHAT_WINDOW_SIZE
 
-    return response
+    rendered = history.rendered(st.session_state.chat_window)
+    if rendered:
+        st.markdown("".join(rendered), unsafe_allow_html=True)
 
 # Pages
 def show_menu_page():
@@ -429,54 +383,68 @@ def show_menu_page():
         unsafe_allow_html=True,
     )
 
-    # Fetch categorized menu items
-    categorized_menu = show_categorized_menu()
+    # Render Menu Items, one pre-rendered block per category
+    for section in menu_sections(current_menu()):
+        st.markdown(section, unsafe_allow_html=True)
 
-    # Render Menu Items Dynamically
+# Build the HTML for each menu category once per menu version, shared by every session
+def menu_sections(snapshot):
+    # The categorized menu is cached on the snapshot too, so look it up before building the sections
+    categorized_menu = show_categorized_menu(snapshot)
+    return snapshot.cached("menu_page_sections", lambda: build_menu_sections(categorized_menu))
+
+def build_menu_sections(categorized_menu):
+    sections = []
     for category, items in categorized_menu.items():
         # Generate a sanitized id for the category
         sanitized_id = category.lower().replace(" & ", "-").replace(" ", "-")
-        st.markdown(f'<h2 id="{sanitized_id}">{category}</h2>', unsafe_allow_html=True)
-        
-        cols = st.columns(4)  # Create 4 columns for items
-        for idx, item in enumerate(items):
-            with cols[idx % 4]:
-                st.markdown(
-                    f"""
-                    <div class="menu-item">
-                        <h4>{item["name"]}</h4>
-                        <p>{item["description"]}</p>
-                        <p><strong>Price:</strong> ${item["price"]:.2f}</p>
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
+        cards = "".join(
+            f'''<div class="menu-item">
+                <h4>{item["name"]}</h4>
+                <p>{item["description"]}</p>
+                <p><strong>Price:</strong> ${item["price"]:.2f}</p>
+            </div>'''
+            for item in items
+        )
+        sections.append(f'<h2 id="{sanitized_id}">{category}</h2><div class="menu-grid">{cards}</div>')
+    return sections
 
 
 def show_order_page():
     st.title("Taco Bell Chatbot")
 
     # Chat Display Container
-    for user_message, bot_response in st.session_state.chat_history:
-        # User message (right-aligned)
-        st.markdown(
-            f'<div class="chat-bubble user-message">{user_message}</div>',
-            unsafe_allow_html=True,
-        )
-        time.sleep(0.5)  # Delay for animation effect
-        # Bot response (left-aligned)
-        st.markdown(
-            f'<div class="chat-bubble bot-message">{bot_response}</div>',
-            unsafe_allow_html=True,
-        )
+    render_chat_history()
+
+    # Answer the message submitted on this rerun. Only this new exchange is animated,
+    # with the bot response rendered as it streams in
+    user_message = st.session_state.pop("pending_message", None)
+    if user_message:
+        timer = MessageTimer()
+        with timer.span("render"):
+            st.markdown(chat_bubble(user_message, "user-message"), unsafe_allow_html=True)
+        response = handle_message(user_message, timer)
+        if not isinstance(response, str):
+            bubble = st.empty()
+            text = ""
+            for chunk in response:
+                text += chunk
+                with timer.span("render"):
+                    bubble.markdown(chat_bubble(text, "bot-message"), unsafe_allow_html=True)
+            response = text.strip()
+        else:
+            time.sleep(0.5)  # Delay for animation effect
+            with timer.span("render"):
+                st.markdown(chat_bubble(response, "bot-message"), unsafe_allow_html=True)
+        st.session_state.chat_history.append(user_message, response)
+        timer.finish(st.session_state.conversation.last_intent)
     st.markdown("</div>", unsafe_allow_html=True)
 
     # Define the message submission handler
     def submit_message():
         if "chat_input" in st.session_state and st.session_state.chat_input.strip():  # Ensure there's input
-            # Append user message and bot response to the chat history
-            response = handle_message(st.session_state.chat_input)
-            st.session_state.chat_history.append((st.session_state.chat_input, response))
+            # Queue the message so the page can answer it while rendering
+            st.session_state.pending_message = st.session_state.chat_input
             # Clear the input box
             st.session_state.chat_input = ""  # Reset input field safely
 
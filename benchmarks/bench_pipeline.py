@@ -0,0 +1,213 @@
+"""
+Benchmarks the per-message NLU and generation pipeline against a checked-in menu fixture, without MongoDB.
+
+    python benchmarks/bench_pipeline.py                        # all stages that can run here
+    python benchmarks/bench_pipeline.py --stages parse_user_input detect_intent --json before.json
+    python benchmarks/bench_pipeline.py --json after.json --compare before.json
+
+Each stage is timed per call over the utterance corpus and reports throughput and p50/p95/p99 latency
+of the successful calls, plus how many calls raised. The menu_listings stage builds each listing on a fresh
+menu snapshot, and counts one that doesn't return as an error.
+Stages whose models can't be loaded (spaCy, GPT-2) are reported as skipped.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+# Use the in-memory menu fixture instead of MongoDB, and never warm up anything behind the benchmark's back
+os.environ.setdefault("MENU_FIXTURE", os.path.join(BENCHMARK_DIR, "menu_fixture.json"))
+os.environ["WARM_UP_ON_BOOT"] = "0"
+
+import chatbot_logic  # noqa: E402
+
+STAGES = ["parse_user_input", "detect_intent", "simplify_sentence", "detect_modifications", "menu_listings",
+          "generate_conversational_response"]
+
+MENU_LISTINGS = ["show_tacos", "show_burritos", "show_nachos", "show_bowls", "show_sides", "show_drinks", "show_sauces",
+                 "show_dairy", "show_gluten_free", "show_menu", "show_categorized_menu"]
+
+
+def load_utterances(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def time_calls(func, inputs, iterations):
+    """
+    Calls func on every input `iterations` times and returns the per-call latencies in seconds of the
+    successful calls, and the number of calls that raised.
+    """
+    latencies = []
+    errors = 0
+    for _ in range(iterations):
+        for args in inputs:
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def summarize(latencies, errors):
+    if not latencies:
+        return {"calls": 0, "errors": errors}
+
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "errors": errors,
+        "throughput_per_s": len(latencies) / total if total else None,
+        "mean_ms": total / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def simplified(utterances):
+    # Feed parsing stages the same lemmatized text handle_message does, or lowercased text if spaCy isn't available
+    try:
+        return chatbot_logic.simplify_sentences(utterances)
+    except Exception:
+        return [utterance.lower() for utterance in utterances]
+
+
+def build_stage(name, utterances, generation_samples):
+    """
+    Returns (function, list of argument tuples) for a stage.
+    """
+    if name == "parse_user_input":
+        return chatbot_logic.parse_user_input, [(text,) for text in simplified(utterances)]
+
+    if name == "detect_intent":
+        return chatbot_logic.detect_intent, [(text,) for text in simplified(utterances)]
+
+    if name == "simplify_sentence":
+        chatbot_logic.spacy_model.get()
+
+        # Measure the uncached path, the cache would otherwise turn every repeat into a dict lookup
+        def simplify_uncached(text):
+            chatbot_logic._lemmatize.cache_clear()
+            return chatbot_logic.simplify_sentence(text)
+        return simplify_uncached, [(text,) for text in utterances]
+
+    if name == "detect_modifications":
+        inputs = []
+        for text in simplified(utterances):
+            for command in chatbot_logic.order_lexer.split_commands(text):
+                item = chatbot_logic.detect_item(command.item_text)
+                if item:
+                    inputs.append((command.text, item))
+        return chatbot_logic.detect_modifications, inputs
+
+    if name == "menu_listings":
+        from menu_store import MenuSnapshot
+        menu = chatbot_logic.current_menu()
+
+        # Every call builds a listing on a fresh snapshot, as after a menu change. Listings use other cached values
+        # of the snapshot, so a build that doesn't return in time is counted as an error instead of hanging the run
+        def build_listing(listing):
+            snapshot = MenuSnapshot(menu.items, menu.version)
+            thread = threading.Thread(target=listing, args=(snapshot,), daemon=True)
+            thread.start()
+            thread.join(5)
+            if thread.is_alive():
+                raise TimeoutError(f"{listing.__name__} didn't return")
+        return build_listing, [(getattr(chatbot_logic, listing),) for listing in MENU_LISTINGS]
+
+    if name == "generate_conversational_response":
+        chatbot_logic.language_model.get()
+        contexts = [f"The user asked: '{text}'" for text in utterances[:generation_samples]]
+        # Without a deadline, so slow generations are timed in full instead of returning the fast template response
+        return chatbot_logic.generate_conversational_response, [(context, "ask_question", None) for context in contexts]
+
+    raise ValueError(f"Unknown stage {name}")
+
+
+def run(stages, utterances, iterations, generation_samples):
+    results = {}
+    for name in stages:
+        try:
+            func, inputs = build_stage(name, utterances, generation_samples)
+        except Exception as e:
+            results[name] = {"skipped": f"{type(e).__name__}: {e}"}
+            continue
+
+        # Generation is orders of magnitude slower than the rest, so it only runs once over its samples
+        stage_iterations = 1 if name == "generate_conversational_response" else iterations
+        time_calls(func, inputs[:1], 1)  # Warm-up call, e.g. to build the menu indexes
+        results[name] = summarize(*time_calls(func, inputs, stage_iterations))
+    return results
+
+
+def print_report(results, baseline=None):
+    print(f"{'stage':34} {'calls':>7} {'errors':>7} {'per s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in results.items():
+        if "skipped" in stats:
+            print(f"{name:34} skipped ({stats['skipped']})")
+            continue
+        if not stats["calls"]:
+            print(f"{name:34} {0:>7} {stats['errors']:>7}")
+            continue
+
+        line = (f"{name:34} {stats['calls']:>7} {stats['errors']:>7} {stats['throughput_per_s']:>10.0f} "
+                f"{stats['p50_ms']:>9.3f} {stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f}")
+        before = (baseline or {}).get(name)
+        if before and "p50_ms" in before and before["p50_ms"]:
+            line += f"   p50 {(stats['p50_ms'] / before['p50_ms'] - 1) * 100:+.1f}% vs baseline"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot NLU and generation pipeline.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--utterances", default=os.path.join(BENCHMARK_DIR, "utterances.txt"))
+    parser.add_argument("--iterations", type=int, default=50, help="passes over the corpus for the fast stages")
+    parser.add_argument("--generation-samples", type=int, default=5, help="utterances used for the generation stage")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to compare p50 latency against")
+    args = parser.parse_args()
+
+    utterances = load_utterances(args.utterances)
+    results = run(args.stages, utterances, args.iterations, args.generation_samples)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+    print_report(results, baseline)
+
+    if args.json:
+        report = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "menu_fixture": os.environ["MENU_FIXTURE"],
+            "utterances": len(utterances),
+            "iterations": args.iterations,
+            "stages": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+import metrics
+
+
+class SQLiteChatStore:
+    """
+    Older chat turns of every session, kept out of process memory in a local SQLite file.
+
+    Each turn is stored as one zlib-compressed row keyed by session and turn number, so menu listings and other long
+    responses take a fraction of their in-memory size. Turns older than `retention` seconds are pruned when the
+    store is opened, since sessions end without telling the server.
+    """
+
+    def __init__(self, path, retention=24 * 3600):
+        self.path = path
+        self._lock = threading.Lock()
+        # Shared by the script threads of every session in this process, behind the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")     # History is a convenience, not worth an fsync per message
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                "session_id TEXT NOT NULL, seq INTEGER NOT NULL, created_at REAL NOT NULL, data BLOB NOT NULL, "
+                "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+            self._db.execute("DELETE FROM turns WHERE created_at < ?", (time.time() - retention,))
+
+    def save(self, session_id, turns):
+        """
+        Stores (seq, user_message, bot_response) turns of the session.
+        """
+        rows = [
+            (session_id, seq, time.time(), zlib.compress(json.dumps([user_message, bot_response]).encode("utf-8")))
+            for seq, user_message, bot_response in turns
+        ]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?)", rows)
+
+    def load(self, session_id, before, limit):
+        """
+        Returns up to limit (user_message, bot_response) turns of the session numbered below before, oldest first.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM turns WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (session_id, before, limit),
+            ).fetchall()
+        return [tuple(json.loads(zlib.decompress(data))) for data, in reversed(rows)]
+
+
+class ChatHistory:
+    """
+    One session's chat turns, with only the most recent ones in memory.
+
+    The in-memory buffer holds at most `max_turns` turns and `budget` bytes (the turns' text plus their rendered
+    HTML from `render`, which turns a (user_message, bot_response) turn into what's shown on the page). Older turns
+    are moved to the store and only read back when the page shows them again, e.g. after "Load older messages".
+    """
+
+    def __init__(self, session_id, store, render, max_turns=20, budget=256 * 1024):
+        self.session_id = session_id
+        self.store = store
+        self.render = render
+        self.max_turns = max_turns
+        self.budget = budget
+        self.memory_bytes = 0
+        self._turns = deque()   # (user_message, bot_response, html, size) of the latest turns
+        self._count = 0         # Turns in the whole conversation, in memory or in the store
+
+    def __len__(self):
+        return self._count
+
+    def recent(self):
+        """
+        Returns the (user_message, bot_response) turns in memory, oldest first.
+        """
+        return [(user_message, bot_response) for user_message, bot_response, _, _ in self._turns]
+
+    def append(self, user_message, bot_response):
+        html = self.render(user_message, bot_response)
+        size = sys.getsizeof(user_message) + sys.getsizeof(bot_response) + sys.getsizeof(html)
+        self._turns.append((user_message, bot_response, html, size))
+        self._count += 1
+        self.memory_bytes += size
+
+        # The latest turn always stays, even if it alone is over budget
+        spilled = []
+        while len(self._turns) > 1 and (len(self._turns) > self.max_turns or self.memory_bytes > self.budget):
+            user_message, bot_response, _, size = self._turns.popleft()
+            self.memory_bytes -= size
+            spilled.append((self._count - len(self._turns) - 1, user_message, bot_response))
+        if spilled:
+            try:
+                self.store.save(self.session_id, spilled)
+            except Exception:
+                logging.exception(f"Couldn't save older chat turns of session {self.session_id}")
+            metrics.chat_turns_spilled.inc(len(spilled))
+        metrics.chat_history_bytes.observe(self.memory_bytes)
+
+    def rendered(self, count):
+        """
+        Returns the HTML of the latest count turns, oldest first, reading any that aren't in memory from the store.
+        """
+        recent = [html for _, _, html, _ in self._turns][-count:]
+        missing = min(count, self._count) - len(recent)
+        if missing <= 0:
+            return recent
+
+        try:
+            older = self.store.load(self.session_id, self._count - len(self._turns), missing)
+        except Exception:
+            logging.exception(f"Couldn't load older chat turns of session {self.session_id}")
+            return recent
+        return [self.render(user_message, bot_response) for user_message, bot_response in older] + recent
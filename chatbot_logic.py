@@ -1,17 +1,22 @@
-import pymongo
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
 from dotenv import load_dotenv
+import concurrent.futures
+import copy
+import functools
+import json
+import logging
 import os
-import re
-import spacy
-
-# Load GPT-2 or a similar model (replace with your model if needed)
-tokenizer = AutoTokenizer.from_pretrained("gpt2")
-model = AutoModelForCausalLM.from_pretrained("gpt2").to("cuda" if torch.cuda.is_available() else "cpu")
-
-# Set the padding token to eos_token (End of Sequence token) to avoid padding errors
-tokenizer.pad_token = tokenizer.eos_token
+import queue
+import socket
+from menu_store import InMemoryCollection, MenuStore
+from order_journal import OrderJournal
+from order_lexer import OrderLexer
+from intent_classifier import IntentClassifier
+from inference_backend import load_model, report_backend
+from inference_batcher import BatchScheduler
+import metrics
+from model_server import ModelClient
+from resources import LazyResource
+from response_pool import ResponsePool
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -19,17 +24,119 @@ load_dotenv()
 # Get the MongoDB URI from the environment variables
 mongodb_uri = os.getenv('MONGODB_URI')
 
-# Connect to MongoDB
-client = pymongo.MongoClient(mongodb_uri)
-db = client["taco_bell_menu"]
-print("Connected to MongoDB")
-menu_items = db["menu_items"]
+# Heavy resources are loaded on first use (or by a background warm-up) instead of at import,
+# so pages that don't need the ML stack can render right away
+
+# Load GPT-2 or a similar model (replace with your model if needed) on the configured inference backend
+# (torch, int8 or onnx), and report its memory, throughput and parity with fp32 at startup
+def _load_language_model():
+    from transformers import AutoTokenizer
+
+    backend = os.getenv("INFERENCE_BACKEND") or "torch"
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    model = load_model(backend, "gpt2")
+
+    # Set the padding token to eos_token (End of Sequence token) to avoid padding errors
+    tokenizer.pad_token = tokenizer.eos_token
+    # GPT-2 generates after the last token, so batched prompts must be padded on the left
+    tokenizer.padding_side = "left"
+
+    if os.getenv("INFERENCE_REPORT", "1") != "0":
+        try:
+            report_backend(backend, tokenizer, model, "gpt2", parity=os.getenv("INFERENCE_PARITY_CHECK", "1") != "0")
+        except Exception:
+            logging.exception("Couldn't report on the %s inference backend", backend)
+    return tokenizer, model
+
+# One MongoDB client, and so one connection pool, shared by everything in the process that talks to MongoDB.
+# Server selection fails fast instead of hanging a worker when MongoDB is slow or down
+@functools.lru_cache(maxsize=None)
+def mongo_client():
+    import pymongo
+
+    return pymongo.MongoClient(
+        mongodb_uri,
+        maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE") or 10),
+        serverSelectionTimeoutMS=int(os.getenv("MONGODB_TIMEOUT_MS") or 5000),
+        connectTimeoutMS=int(os.getenv("MONGODB_TIMEOUT_MS") or 5000),
+        appname="tacobell-chatbot",
+    )
+
+# The only menu item fields the chatbot reads, so fetches skip everything else in the documents
+menu_fields = ["name", "price", "description", "tags", "ingredients"]
+
+# Retrieve the menu items from MongoDB, then keep them in sync with the collection in the background.
+# Workers start from the menu snapshot file the last process saved, if there is one, and only fetch what changed
+# since then in the background, instead of every worker reading the whole collection on startup.
+# Setting MENU_FIXTURE to a JSON list of menu items runs without MongoDB (benchmarks, offline development)
+def _load_menu_store():
+    fixture = os.getenv("MENU_FIXTURE")
+    if fixture:
+        with open(fixture, encoding="utf-8") as f:
+            store = MenuStore(InMemoryCollection(json.load(f)))
+        store.load()
+        return store
+
+    store = MenuStore(
+        mongo_client()["taco_bell_menu"]["menu_items"],
+        poll_interval=float(os.getenv("MENU_POLL_INTERVAL") or 30),
+        fields=menu_fields,
+        snapshot_path=os.getenv("MENU_SNAPSHOT_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "menu_snapshot.bson"),
+    )
+    if store.load_snapshot():
+        store.start(os.getenv("MENU_SYNC") or "watch", reconcile=True)
+        return store
+
+    store.load()
+    print("Connected to MongoDB")
+    store.start(os.getenv("MENU_SYNC") or "watch")
+    return store
+
+# Load spaCy model. Only lemmas are used, and the lemmatizer only needs the tagger and attribute ruler,
+# so the dependency parser and NER are left out entirely
+def _load_spacy_model():
+    import spacy
+
+    return spacy.load("en_core_web_sm", exclude=["parser", "ner"])
+
+# With MODEL_SERVER_SOCKET set, a model server process (python model_server.py) owns the spaCy and GPT-2 models
+# for every process on the node, and this process only sends it lemmatization and generation requests
+model_server_socket = os.getenv("MODEL_SERVER_SOCKET")
+
+def _connect_model_server():
+    client = ModelClient(model_server_socket)
+    client.ping()
+    return client
+
+# Completed orders are journaled to local disk before the cart is cleared, and shipped to the orders collection in the
+# background, so checkout neither waits for MongoDB nor loses orders while it's down. Loading the journal ships
+# whatever a previous run left unshipped. With MENU_FIXTURE orders are only journaled
+def _load_order_journal():
+    collection = None
+    if not os.getenv("MENU_FIXTURE"):
+        collection = lambda: mongo_client()["taco_bell_menu"]["orders"]
+    journal = OrderJournal(
+        os.getenv("ORDER_JOURNAL_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "order_journal"),
+        collection,
+        max_wait=float(os.getenv("ORDER_JOURNAL_COMMIT_WAIT_MS") or 2) / 1000,
+        ship_interval=float(os.getenv("ORDER_JOURNAL_SHIP_INTERVAL") or 1),
+    )
+    journal.start()
+    return journal
 
-# Retrieve all menu items
-menu_items = list(menu_items.find({}))
+menu_store = LazyResource("menu", _load_menu_store)
+order_journal = LazyResource("order_journal", _load_order_journal)
+spacy_model = LazyResource("spacy_model", _load_spacy_model, register=not model_server_socket)
+language_model = LazyResource("language_model", _load_language_model, register=not model_server_socket)
+model_server = LazyResource("model_server", _connect_model_server, register=bool(model_server_socket))
 
-# Load spaCy model
-nlp = spacy.load("en_core_web_sm")
+# Journal the session's completed order and return its id
+def journal_order(session):
+    return order_journal.get().append(session.order.to_dict(), session.session_id)
+
+# The current menu snapshot. It builds its name index once, so item lookups scan the input instead of the whole menu
+def current_menu():
+    return menu_store.get().snapshot
 
 intents = {
     'add_item': ['want', 'get', 'add', 'have', 'do'],
@@ -52,37 +159,37 @@ intents = {
     'cancel_order': ['cancel', 'clear', 'reset']
 }
 
-# Define modification patterns
-modification_patterns = [
-    (r"\b(?:no|without)\b\s*(\w+)", "remove"),  # e.g., "no pickles" or "without pickles" 
-    (r"\b(?:extra|additional|more)\b\s*(\w+)", "add"),  # e.g., "extra cheese"
-    (r"\b(?:substitute|swap|replace)\b\s*(\w+)\s*with\s*(\w+)", "substitute"),  # e.g., "substitute lettuce with onions"
+# Intents from highest to lowest priority, for inputs where two intents score the same
+# (e.g. "remove a taco" is remove_item, and "I want a taco" is add_item, not get_tacos)
+intent_priority = [
+    'cancel_order', 'complete_order', 'remove_item', 'get_price', 'get_description', 'add_item', 'view_order',
+    'get_tacos', 'get_burritos', 'get_nachos', 'get_bowls', 'get_sides', 'get_drinks', 'get_sauces',
+    'get_dairy', 'get_gluten_free', 'get_menu', 'ask_question',
 ]
 
-text_to_number = {
-    'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
-    'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10', 'eleven': '11',
-    'twelve': '12', 'thirteen': '13', 'fourteen': '14', 'fifteen': '15', 'sixteen': '16',
-    'seventeen': '17', 'eighteen': '18', 'nineteen': '19', 'twenty': '20', 'twenty-one': '21',
-    'twenty-two': '22', 'twenty-three': '23', 'twenty-four': '24', 'twenty-five': '25',
-    'twenty-six': '26', 'twenty-seven': '27', 'twenty-eight': '28', 'twenty-nine': '29',
-    'thirty': '30', 'thirty-one': '31', 'thirty-two': '32', 'thirty-three': '33',
-    'thirty-four': '34', 'thirty-five': '35', 'thirty-six': '36', 'thirty-seven': '37',
-    'thirty-eight': '38', 'thirty-nine': '39', 'forty': '40', 'forty-one': '41',
-    'forty-two': '42', 'forty-three': '43', 'forty-four': '44', 'forty-five': '45',
-    'forty-six': '46', 'forty-seven': '47', 'forty-eight': '48', 'forty-nine': '49',
-    'fifty': '50', 'fifty-one': '51', 'fifty-two': '52', 'fifty-three': '53', 'fifty-four': '54',
-    'fifty-five': '55', 'fifty-six': '56', 'fifty-seven': '57', 'fifty-eight': '58', 'fifty-nine': '59',
-    'sixty': '60', 'sixty-one': '61', 'sixty-two': '62', 'sixty-three': '63', 'sixty-four': '64',
-    'sixty-five': '65', 'sixty-six': '66', 'sixty-seven': '67', 'sixty-eight': '68', 'sixty-nine': '69',
-    'seventy': '70', 'seventy-one': '71', 'seventy-two': '72', 'seventy-three': '73', 'seventy-four': '74',
-    'seventy-five': '75', 'seventy-six': '76', 'seventy-seven': '77', 'seventy-eight': '78', 'seventy-nine': '79',
-    'eighty': '80', 'eighty-one': '81', 'eighty-two': '82', 'eighty-three': '83', 'eighty-four': '84',
-    'eighty-five': '85', 'eighty-six': '86', 'eighty-seven': '87', 'eighty-eight': '88', 'eighty-nine': '89',
-    'ninety': '90', 'ninety-one': '91', 'ninety-two': '92', 'ninety-three': '93', 'ninety-four': '94',
-    'ninety-five': '95', 'ninety-six': '96', 'ninety-seven': '97', 'ninety-eight': '98', 'ninety-nine': '99'
+# Keywords that count for more or less than 1 towards their intent's score
+keyword_weights = {
+    'remove': 1.5, 'delete': 1.5,
+    'price': 1.5, 'cost': 1.5, 'much': 1.5,
+    'describe': 1.5, 'description': 1.5,
+    'dairy': 1.5, 'gluten': 1.5,                    # "which items have dairy" asks about dairy
+    'menu': 0.75, 'items': 0.75,                    # "power menu bowl" is a bowl
+    'my': 0.25, 'current': 0.5, 'order': 0.5, 'cart': 0.5,
+    'checkout': 2, 'complete': 2, 'finish': 2,      # "finish my order" shouldn't lose to view_order
+    'cancel': 2, 'clear': 2, 'reset': 2,
+}
+
+# Word pairs that turn an ordering keyword into a question, e.g. "do you have nachos" asks about nachos
+phrase_weights = {
+    ('do', 'you'): ('add_item', -1),
+    ('you', 'have'): ('add_item', -1),
 }
 
+intent_classifier = IntentClassifier(intents, intent_priority, keyword_weights, phrase_weights)
+
+# Compile the order tokenizer once instead of rebuilding its patterns on every message
+order_lexer = OrderLexer(intents["add_item"], intents["remove_item"])
+
 def parse_user_input(user_input):
     """
     Parses the user's input to extract multiple commands for intents (add_item/remove_item), menu items,
@@ -91,191 +198,188 @@ def parse_user_input(user_input):
     Returns:
         list[dict]: A list of dictionaries containing 'intent', 'item', 'quantity', and 'modifications' for each command.
     """
-    intent_pattern = r'\b(?:' + '|'.join(intents["add_item"] + intents["remove_item"]) + r')\b'
-    quantity_pattern = r'\b(?:' + '|'.join(text_to_number.keys()) + r'|\d+)\b'
-    size_keywords = ["small", "medium", "large"]
-    size_pattern = r'\b(' + '|'.join(size_keywords) + r')\b'    # Find all occurrences of size keywords in the sentence
-    pattern = (
-        r'(?:\s*+(?P<quantity>' + quantity_pattern + r'))?'  # Match quantity (optional)
-        r'\s*+(?P<item>.+?)(?:s\b|$)'  # Match item
-    )
-
-    # Split the input into potential commands
-    delimiters = [',', 'and', ';', '&']
-    for delimiter in delimiters:
-        user_input = user_input.replace(delimiter, "|")
-
-    # Split the input keeping quantity amounts
-    for word, number in text_to_number.items():
-        user_input = user_input.replace(f" {word} ", f"| {word} ")
-        user_input = user_input.replace(f" {number} ", f"| {number} ")
-    
-    commands = user_input.split("|") # Split input into individual commands
-
     results = []
     intent = "add_item"
-    for command in commands:
+    # Delimiters and numbers inside item names ("cheesy bean and rice burrito") don't split commands
+    item_spans = [(start, end) for start, end, _ in current_menu().matcher.find_all(user_input)]
+    for command in order_lexer.split_commands(user_input, item_spans):
         # Check if intent is specified, otherwise defaults to 'add_item'
-        intent_match = re.search(intent_pattern, command.strip(), re.IGNORECASE)
-        if intent_match:
-            # Extract intent and determine whether it's an add or remove action
-            intent_word = intent_match.group(0).lower()
-            intent = "add_item" if intent_word in intents["add_item"] else "remove_item"
-
-        match = re.search(pattern, command.strip(), re.IGNORECASE)
-        if match:
-            # Extract item name
-            item_name = match.group("item").strip()
-            item = detect_item(item_name.lower())
-
-            # Continue to next command if current command was changing intent
-            if not item and intent_match:
-                continue
-
-            # Extract quantity, converting text-based numbers to integers if necessary
-            quantity_raw = match.group("quantity")
-            if quantity_raw:
-                quantity = int(text_to_number.get(quantity_raw, quantity_raw))  # Handle text or digit
-            else:
-                quantity = 1  # Default quantity is 1 if none is specified
-
-            # Extract modifications
-            modifications = detect_modifications(command, item) if item else []
-
-            # Extract size
-            size = None
-            size_match = re.search(size_pattern, command.strip(), re.IGNORECASE)
-            if item and is_drink(item):
-                size = size_match.group(0) if size_match else "medium"
-
-            results.append({
-                "intent": intent,
-                "item": item,
-                "quantity": quantity,
-                "modifications": modifications,
-                "size": size
-            })
+        if command.intent_word:
+            # Determine whether it's an add or remove action
+            intent = "add_item" if command.intent_word in intents["add_item"] else "remove_item"
+
+        # Extract item name
+        item = detect_item(command.item_text.lower())
+
+        # Continue to next command if current command was changing intent
+        if not item and command.intent_word:
+            continue
+
+        # Quantity words are already converted to integers by the lexer
+        quantity = command.quantity if command.quantity is not None else 1  # Default quantity is 1 if none is specified
+
+        # Modifications split off from the previous item's command ("... with no onions" and "extra cheese") belong to it
+        if not item and command.quantity is None and results and results[-1]["item"] \
+                and current_menu().modification_engine.starts_with_modification(command.text):
+            previous = results[-1]
+            previous["modifications"] = list(dict.fromkeys(previous["modifications"] + detect_modifications(command.text, previous["item"])))
+            continue
+
+        # Extract modifications
+        modifications = detect_modifications(command.text, item) if item else []
+
+        # Extract size
+        size = None
+        if item and is_drink(item):
+            size = command.size or "medium"
+
+        results.append({
+            "intent": intent,
+            "item": item,
+            "quantity": quantity,
+            "modifications": modifications,
+            "size": size
+        })
 
     return results
 
 # Simplify sentence using spaCy
 def simplify_sentence(user_input):
-    doc = nlp(user_input.lower())
-    simplified_sentence = []
+    return _lemmatize(user_input.lower())
 
-    for token in doc:
-        simplified_sentence.append(token.lemma_)
+# Repeated utterances ("checkout", "view my order") are served from the cache instead of running spaCy
+@functools.lru_cache(maxsize=int(os.getenv("LEMMA_CACHE_SIZE") or 4096))
+def _lemmatize(text):
+    if model_server_socket:
+        return model_server.get().lemmatize([text])[0]
+    return _join_lemmas(spacy_model.get()(text))
 
-    return " ".join(simplified_sentence)
+def _join_lemmas(doc):
+    return " ".join(token.lemma_ for token in doc)
 
-# Remove the context message from the chatbot's output
-def remove_context(response):
-    system_prompt = "You are a chatbot for a Taco Bell restaurant. Your job is to assist customers in answering questions about the menu and placing their orders. Only respond to questions or commands related to ordering food. Do not generate any other kind of response."
-    new_response = response.replace(system_prompt, "")
-    new_response = new_response.replace("\n", "", 2)
-    return new_response
+# Simplify many sentences at once with nlp.pipe, e.g. when replaying logged conversations offline
+def simplify_sentences(user_inputs, batch_size=256):
+    if model_server_socket:
+        return model_server.get().lemmatize(user_inputs)
+    docs = spacy_model.get().pipe((user_input.lower() for user_input in user_inputs), batch_size=batch_size)
+    return [_join_lemmas(doc) for doc in docs]
 
 # Identify intent from keywords
 def detect_intent(input):
-    for word in input.split():
-        for intent, keywords in intents.items():
-            if word in keywords:
-                return intent
+    return intent_classifier.classify(input)
 
-    return 'unknown_intent'
+# Identify the intents of many inputs at once, e.g. for analytics over logged utterances
+def detect_intents(inputs):
+    return intent_classifier.classify_batch(inputs)
 
-# Detect the item in the order (e.g., "Burger", "Pizza")
+# Detect the item in the order (e.g., "Burger", "Pizza"). Exact name mentions are found first, then misspelled
+# or partial ones ("chalupa supreem", "crunchwrap"), which would otherwise end up as "couldn't understand" responses
 def detect_item(input_text):
-    for item in menu_items:
-        if item["name"].lower() in input_text:
-            return item
-    return None
+    menu = current_menu()
+    return menu.matcher.find(input_text) or menu.fuzzy_matcher.find(input_text)
+
+# Items the input might have meant when none matched well enough, best first
+def suggest_items(input_text, limit=3, min_score=0.4):
+    return [item for item, score in current_menu().fuzzy_matcher.search(input_text, limit) if score >= min_score]
 
 # Detect if the item is a drink (e.g. Pepsi, MTN DEW)
 def is_drink(item):
     return "drink" in item["tags"] or "Drinks" in item["tags"]
 
-# Detect modifications (like "no lettuce", "extra cheese", etc.)
+# Detect modifications (like "no lettuce", "extra cheese", etc.) as structured Modifications, checked against
+# the item's ingredients, which are indexed once per menu version
 def detect_modifications(input_text, item):
-    modifications = []
-    for pattern, action in modification_patterns:
-        matches = re.findall(pattern, input_text, flags=re.IGNORECASE)
-        for match in matches:
-            if action == "remove":
-                if match.lower() in item["ingredients"]:
-                    modifications.append(f"no {match}")
-            elif action == "add":
-                if match.lower() not in item["ingredients"]:
-                    modifications.append(f"add {match}")
-            elif action == "substitute":
-                parts = match.split(" with ")
-                if len(parts) == 2:
-                    old, new = parts
-                    if old.lower() in item["ingredients"]:
-                        modifications.append(f"substitute {old} with {new}")
-    return modifications
+    return current_menu().modification_engine.detect(input_text, item)
 
 # Apply modifications to an item and return a summary of the changes
 def apply_modifications(modifications):
     if not modifications:
         return "No modifications."
-    return ", ".join(modifications)
+    return ", ".join(str(modification) for modification in modifications)
 
 def get_price(user_input):
-    for item in menu_items:
-        if item['name'].lower() in user_input.lower():
-            return f"The price of {item['name']} is ${item['price']}."
+    item = detect_item(user_input)
+    if item:
+        return f"The price of {item['name']} is ${item['price']}."
+    suggestions = suggest_items(user_input)
+    if suggestions:
+        return f"I couldn't find that item in the menu. Did you mean {' or '.join(item['name'] for item in suggestions)}?"
     return "I couldn't find that item in the menu."
 
 def get_description(user_input):
-    for item in menu_items:
-        if item['name'].lower() in user_input.lower():
-            return f"{item['description']}"
+    item = detect_item(user_input)
+    if item:
+        return f"{item['description']}"
     return ""
 
+# Memoize a listing per menu version. The decorated function receives the menu snapshot and is called
+# with no arguments for the current menu, e.g. show_tacos(), or with a specific snapshot
+def cached_per_menu_version(build_listing):
+    @functools.wraps(build_listing)
+    def listing(snapshot=None):
+        if snapshot is None:
+            snapshot = current_menu()
+        return snapshot.cached(build_listing.__name__, lambda: build_listing(snapshot))
+    return listing
+
+# Format menu items as "name - $price" lines
+def price_list(items):
+    return "\n\n".join([f"{item['name']} - ${item['price']}" for item in items])
+
 # Retrieve and display various menu items, categorized by type (tacos, burritos, nachos, bowls, sides, drinks, sauces, dairy, gluten-free)
 # and provide formatted output including item names and prices. Each function generates a message tailored to its specific category.
-def show_tacos():
-    tacos = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "taco" in item["tags"]])
+@cached_per_menu_version
+def show_tacos(snapshot):
+    tacos = price_list(snapshot.with_tag("taco"))
     return f"We’ve got a variety of delicious tacos to choose from. Here are some of our options:\n\n{tacos}"
 
-def show_burritos():
-    burritos = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "taco" in item["tags"]])
+@cached_per_menu_version
+def show_burritos(snapshot):
+    burritos = price_list(snapshot.with_tag("taco"))
     return f"Here’s a list of our delicious burritos at Taco Bell:\n\n{burritos}"
 
-def show_nachos():
-    nachos = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "nachos" in item["tags"]])
+@cached_per_menu_version
+def show_nachos(snapshot):
+    nachos = price_list(snapshot.with_tag("nachos"))
     return f"Great question! We have several delicious nacho options for you:\n\n{nachos}"
 
-def show_bowls():
-    bowls = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "bowl" in item["tags"]])
+@cached_per_menu_version
+def show_bowls(snapshot):
+    bowls = price_list(snapshot.with_tag("bowl"))
     return f"We have a variety of delicious bowls to satisfy your cravings! Our options include:\n\n{bowls}"
 
-def show_sides():
-    sides = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "side" in item["tags"]])
+@cached_per_menu_version
+def show_sides(snapshot):
+    sides = price_list(snapshot.with_tag("side"))
     return f"Here are the sides we offer at Taco Bell:\n\n{sides}"
 
-def show_drinks():
-    drinks = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "drink" in item["tags"]])
+@cached_per_menu_version
+def show_drinks(snapshot):
+    drinks = price_list(snapshot.with_tag("drink"))
     return f"At Taco Bell, we offer a variety of refreshing drinks to complement your meal. Here's what we have:\n\n{drinks}"
 
-def show_sauces():
-    sauces = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "sauce" in item["tags"]])
+@cached_per_menu_version
+def show_sauces(snapshot):
+    sauces = price_list(snapshot.with_tag("sauce"))
     return f"At Taco Bell, we have a variety of delicious sauces to choose from! Here’s a list of what we offer:\n\n{sauces}"
 
-def show_dairy():
-    dairy = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "dairy" in item["tags"]])
+@cached_per_menu_version
+def show_dairy(snapshot):
+    dairy = price_list(snapshot.with_tag("dairy"))
     return f"Many of our menu items contain dairy, including cheese, sour cream, and sauces. Some of the items that typically contain dairy include:\n\n{dairy}"
 
-def show_gluten_free():
-    gluten_free = "\n\n".join([f"{item['name']} - ${item['price']}" for item in menu_items if "gluten" not in item["tags"]])
+@cached_per_menu_version
+def show_gluten_free(snapshot):
+    gluten_free = price_list(snapshot.without_tag("gluten"))
     return f"At Taco Bell, we offer several gluten-free options, though please keep in mind that cross-contamination is always possible due to shared kitchen equipment. Here are some of our gluten-free choices:\n\n{gluten_free}"
 
-def show_menu():
-    menu_str = "\n\n".join([f"{item['name']} - ${item['price']} : {item['description']}" for item in menu_items])
+@cached_per_menu_version
+def show_menu(snapshot):
+    menu_str = "\n\n".join([f"{item['name']} - ${item['price']} : {item['description']}" for item in snapshot])
     return f"Here's what's on our Taco Bell menu:\n\n{menu_str}"
 
-def show_categorized_menu():
+@cached_per_menu_version
+def show_categorized_menu(snapshot):
     # Initialize categories in the specified order
     categories = [
         "Tacos",
@@ -292,7 +396,7 @@ def show_categorized_menu():
     categorized_menu = {category: [] for category in categories}  # Create empty lists for each category
 
     # Categorize items based on their tags
-    for item in menu_items:
+    for item in snapshot:
         if "tags" in item:  # Check if tags exist
             for category in categories:
                 if category in item["tags"]:  # Match tags to categories
@@ -305,29 +409,261 @@ def show_categorized_menu():
 
     return categorized_menu
 
-# Function to generate conversational responses using GPT-2 or another model
-def generate_conversational_response(context):
-    # Define the system prompt that sets the behavior of the chatbot
-    system_prompt = (
-        "You are a chatbot for a Taco Bell restaurant. Your job is to assist customers in answering questions about the menu and placing their orders. "
-        "Only respond to questions or commands related to ordering food. Do not generate any other kind of response. "
+# Per-request generation budget in seconds, and the most tokens a response may add to its context
+generation_deadline = float(os.getenv("GENERATION_DEADLINE_MS") or 2000) / 1000
+generation_max_new_tokens = int(os.getenv("GENERATION_MAX_NEW_TOKENS") or 40)
+
+# Deterministic responses for when generation misses its deadline, appended to the context like a generated reply
+fallback_responses = {
+    "add_item": "Anything else I can get for you?",
+    "remove_item": "Anything else I can change for you?",
+    "ask_question": "Sorry, I can only help with questions about the menu and your order.",
+    "complete_order": "Thanks for ordering from Taco Bell!",
+    "cancel_order": "Your order has been cancelled.",
+    "unknown_intent": "Sorry, I didn't catch that. Could you say it another way?",
+    "empty_order": "You haven't ordered anything yet.",
+    "item_not_found": "Sorry, I couldn't find that on the menu.",
+    "order_failed": "Sorry, we couldn't place your order right now. Your order has been kept, so please try again.",
+}
+default_fallback_response = "How else can I help with your order?"
+
+# Function to generate conversational responses using GPT-2 or another model.
+# The response is the context followed by the model's continuation of it, or by the intent's template response
+# when generation doesn't finish within the deadline (in seconds) or fails. Without a deadline, it waits for
+# generation however long it takes and raises its errors (e.g. for pre-generated responses)
+def generate_conversational_response(context, intent="unknown_intent", deadline=generation_deadline):
+    # Concurrent sessions (and, through the model server, concurrent processes) share one batched model.generate call
+    if model_server_socket:
+        generate = lambda: model_server.get().generate(context, intent, deadline)
+    else:
+        generate = lambda: generation_scheduler.generate(context, timeout=deadline)
+    if deadline is None:
+        return generate()
+
+    try:
+        return generate()
+    except (concurrent.futures.TimeoutError, socket.timeout):
+        reason = "deadline"
+    except Exception:
+        logging.exception("Generation failed")
+        reason = "error"
+    return fallback_response(context, intent, reason)
+
+# Answer the context with the intent's template response, and count the fallback
+def fallback_response(context, intent, reason):
+    metrics.generation_fallbacks.inc(intent=intent, reason=reason)
+    return f"{context} {fallback_responses.get(intent, default_fallback_response)}"
+
+# The system prompt that sets the behavior of the chatbot
+system_prompt = (
+    "You are a chatbot for a Taco Bell restaurant. Your job is to assist customers in answering questions about the menu and placing their orders. "
+    "Only respond to questions or commands related to ordering food. Do not generate any other kind of response."
+)
+
+# Combine the system prompt with the current context
+def build_prompt(context):
+    return f"{system_prompt}\n\n{context}"
+
+# Run the constant system prompt through the model once, so every generation only prefills its own context
+# and continues from the prompt's cached keys and values. Backends that can't take a cache (onnx) get None
+def _build_prompt_cache():
+    import torch
+
+    tokenizer, model = language_model.get()
+    if not isinstance(model, torch.nn.Module) or os.getenv("PROMPT_CACHE", "1") == "0":
+        return None
+
+    input_ids = tokenizer(system_prompt, return_tensors="pt")["input_ids"].to(model.device)
+    with torch.no_grad():
+        # A tuple of per-layer (key, value) tensors on older GPT-2 implementations, a Cache object on newer ones
+        past_key_values = model(input_ids, use_cache=True).past_key_values
+    return input_ids[0], past_key_values
+
+prompt_cache = LazyResource("prompt_cache", _build_prompt_cache, register=not model_server_socket)
+
+# Build the generate() inputs for a batch of contexts: the system prompt's tokens followed by each context's,
+# left-padded in between so every context ends where generation starts (padding is masked out and skipped by
+# the position ids). With the prompt cache, generate() only runs the tokens after the cached prompt
+def _generation_inputs(contexts):
+    import torch
+
+    tokenizer, model = language_model.get()
+    cache = prompt_cache.get()
+    if cache is None:
+        inputs = tokenizer([build_prompt(context) for context in contexts], return_tensors="pt", padding=True, truncation=True).to(model.device)
+        return dict(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+
+    prompt_ids, past_key_values = cache
+    batch_size = len(contexts)
+    inputs = tokenizer([f"\n\n{context}" for context in contexts], return_tensors="pt", padding=True).to(model.device)
+
+    # Legacy caches are only ever concatenated onto, never written into, so one copy can be shared (expanded,
+    # not copied) across concurrent batches. Cache objects are updated in place and get a copy per batch
+    if isinstance(past_key_values, tuple):
+        past_key_values = tuple(
+            (key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1)) for key, value in past_key_values
+        )
+    else:
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(batch_size)
+
+    prompt_ids = prompt_ids.expand(batch_size, -1)
+    return dict(
+        input_ids=torch.cat([prompt_ids, inputs["input_ids"]], dim=1),
+        attention_mask=torch.cat([torch.ones_like(prompt_ids), inputs["attention_mask"]], dim=1),
+        past_key_values=past_key_values,
     )
-    
-    # Combine the system prompt with the current context
-    full_prompt = f"{system_prompt}\n\n{context}"
-    
-    # Tokenize the prompt
-    inputs = tokenizer(full_prompt, return_tensors="pt", padding=True, truncation=True).to(model.device)
+
+# Stream a conversational response as text chunks while the model generates it, starting with the context.
+# Streamed requests join the same batched model.generate calls as the others, each reading its own row's text.
+# If no text is generated within the deadline, or generation fails, the stream ends with the intent's template response
+def stream_conversational_response(context, intent="unknown_intent"):
+    if model_server_socket:
+        return _stream_from_model_server(context, intent)
+
+    request = _StreamRequest(context)
+    request.future = generation_scheduler.submit(request)
+    # Ends the stream as soon as its batch fails too (e.g. the model couldn't load), not only once it's generated
+    request.future.add_done_callback(lambda future: request.text_queue.put(None))
+    return _stream_with_fallback(context, intent, request)
+
+class _StreamRequest:
+    """
+    A streamed generation request. The batch it runs in decodes its row into text_queue, ending with None.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.text_queue = queue.Queue()
+        self.future = None
+
+def _stream_with_fallback(context, intent, request):
+    yield context
+
+    generated = False
+    try:
+        while True:
+            chunk = request.text_queue.get(timeout=generation_deadline)
+            if chunk is None:
+                break
+            if chunk:
+                generated = generated or bool(chunk.strip())
+                yield chunk
+    except queue.Empty:
+        # Nothing arrived within the deadline, drop the request if its batch hasn't started yet
+        request.future.cancel()
+
+    if not generated:
+        failed = request.future.done() and not request.future.cancelled() and request.future.exception() is not None
+        yield fallback_response("", intent, "error" if failed else "deadline")
+
+# The model server applies the deadline and fallback to the stream itself, this only covers the server being unreachable
+def _stream_from_model_server(context, intent):
+    streamed = False
+    try:
+        for chunk in model_server.get().stream(context, intent, chunk_timeout=generation_deadline + 1):
+            streamed = True
+            yield chunk
+    except Exception:
+        logging.exception("Streaming from the model server failed")
+        yield fallback_response("" if streamed else context, intent, "error")
+
+# Bound every generation: a few new tokens, stopping at the end of the first sentence, and never running past the
+# deadline. Hard tail latency matters more here than longer replies
+def _generation_limits(tokenizer):
+    return dict(
+        max_new_tokens=generation_max_new_tokens,
+        max_time=generation_deadline,
+        stop_strings=[".", "!", "?"],
+        tokenizer=tokenizer,
+    )
+
+# Hands each row of a batched generation to the streamer of its request, if it's streamed.
+# TextIteratorStreamer only takes a batch of one, so each streamer gets its own row's tokens
+class _BatchStreamer:
+    def __init__(self, streamers):
+        self.streamers = streamers
+
+    def put(self, value):
+        for row, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(value[row:row + 1])
+
+    def end(self):
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+def _batch_streamer(tokenizer, requests):
+    from transformers import TextIteratorStreamer
+
+    streamers = []
+    for request in requests:
+        streamer = None
+        if isinstance(request, _StreamRequest):
+            # The streamer decodes only the new tokens, into the queue the request's caller is reading
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            streamer.text_queue = request.text_queue
+        streamers.append(streamer)
+    return _BatchStreamer(streamers) if any(streamers) else None
+
+# Generate responses for a batch of requests (contexts, or streamed requests) in a single model.generate call
+def _generate_batch(requests):
+    contexts = [request.context if isinstance(request, _StreamRequest) else request for request in requests]
+    tokenizer, model = language_model.get()
+    inputs = _generation_inputs(contexts)
 
     # Generate a response from the model using the input tokens and attention mask
     outputs = model.generate(
-        inputs["input_ids"], 
-        attention_mask=inputs["attention_mask"],  
-        max_length=150, 
-        pad_token_id=tokenizer.eos_token_id,  
-        do_sample=True
+        **inputs,
+        **_generation_limits(tokenizer),
+        pad_token_id=tokenizer.eos_token_id,
+        do_sample=True,
+        streamer=_batch_streamer(tokenizer, requests),
     )
 
-    # Decode the model's output to get the generated text
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response.strip()
\ No newline at end of file
+    # Decode only the newly generated tokens, the prompt is never decoded back into text
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+    return [
+        f"{context}{text}".strip()
+        for context, text in zip(contexts, tokenizer.batch_decode(new_tokens, skip_special_tokens=True))
+    ]
+
+generation_scheduler = BatchScheduler(
+    _generate_batch,
+    max_batch_size=int(os.getenv("GENERATION_BATCH_SIZE") or 8),
+    max_wait=float(os.getenv("GENERATION_BATCH_WAIT_MS") or 10) / 1000,
+)
+
+# Constant contexts whose responses are pre-generated instead of sampled on every request
+fixed_contexts = {
+    "cancel_order": "The user cancelled the entire order.",
+    "unknown_intent": "The chatbot couldn't understand the user's question.",
+    "item_not_found": "The chatbot couldn't find what the user was looking for.",
+    "empty_order": "The user asked to see their current order, but the user has not ordered anything.",
+    "order_failed": "The chatbot couldn't place the user's order because of a technical problem, but kept the order so the user can try again.",
+}
+
+# Template answer for a fixed context whose pool is still empty, so fixed responses never wait on (or fail with) the model
+def _fixed_fallback_response(context):
+    name = next(name for name, fixed_context in fixed_contexts.items() if fixed_context == context)
+    return fallback_response(context, name, "empty_pool")
+
+# Pools are filled in the background without a deadline, the responses are worth waiting for there
+response_pool = ResponsePool(
+    lambda context: generate_conversational_response(context, deadline=None),
+    os.getenv("RESPONSE_POOL_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "response_pool.json"),
+    size=int(os.getenv("RESPONSE_POOL_SIZE") or 8),
+    rotate_interval=float(os.getenv("RESPONSE_POOL_ROTATE_SECONDS") or 600),
+    fallback=_fixed_fallback_response,
+)
+
+# Serve a pre-generated response for one of the fixed contexts
+def get_fixed_response(name):
+    return response_pool.get(fixed_contexts[name])
+
+# Fill any pools that aren't full yet in the background (e.g. on the first boot without a pool file)
+def warm_up_response_pool():
+    contexts = [context for context in fixed_contexts.values() if response_pool.available(context) < response_pool.size]
+    if contexts:
+        response_pool.refill_async(contexts)
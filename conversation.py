@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from chatbot_logic import parse_user_input, simplify_sentence, detect_intent, get_price, get_description, show_tacos, show_burritos, show_nachos, show_bowls, show_sides, show_drinks, show_sauces, show_dairy, show_gluten_free, show_menu, generate_conversational_response, stream_conversational_response, get_fixed_response, journal_order
+from metrics import MessageTimer
+from order_model import Order, format_item_name, normalize_modifications
+
+
+class ConversationSession:
+    """
+    State of one customer's conversation, independent of the UI it comes from (Streamlit, HTTP API, ...).
+    """
+
+    def __init__(self, session_id=None, order=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.order = order if order is not None else Order()
+        self.last_intent = None
+        self.last_active = time.time()
+
+    def to_dict(self):
+        return {"session_id": self.session_id, "order": self.order.to_dict()}
+
+
+class InMemorySessionStore:
+    """
+    Keeps sessions in process memory, evicting the least recently used ones beyond max_sessions.
+
+    This is the default session storage. Another backend (e.g. Redis or MongoDB) can be used instead
+    by implementing the same get, create and save methods.
+    """
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def create(self, session_id=None):
+        session = ConversationSession(session_id)
+        self.save(session)
+        return session
+
+    def save(self, session):
+        session.last_active = time.time()
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+# Update order
+def update_order(session, commands):
+    responses = []
+    order = session.order
+
+    for command in commands:
+        intent, item, quantity, modifications, size = command.values()
+
+        # Check if the item is recognized
+        if not item:
+            responses.append("An item in the user's order could not be recognized.")
+            continue    # Skip to the next command
+
+        have_or_has = "have" if quantity > 1 else "has"
+
+        # Handle the 'add_item' intent
+        if intent == "add_item":
+            line = order.add(item, quantity, size, modifications)  # Update the order and total with the added items
+            item_name = line.display_name + ("s" if quantity > 1 else "")
+            # Generate response message about the added items
+            responses.append(f"{quantity} {item_name} {have_or_has} been added to your order.")
+
+        elif intent == "remove_item":
+            amount = order.remove(item, quantity, size, modifications)  # Update the order and total after removal
+            item_name = format_item_name(item["name"], size, normalize_modifications(modifications)) + ("s" if quantity > 1 else "")
+            # Generate response message about the removed items
+            responses.append(f"{amount} {item_name} {have_or_has} been removed from your order.")
+    
+    # Return all the responses as a single string, joining them with a space
+    return " ".join(responses)
+
+def process_user_input(session, user_input):
+    commands = parse_user_input(user_input)
+    response = update_order(session, commands)
+    return response
+
+def print_order(session):
+    order = []
+
+    for line in session.order:
+        order.append(f"{line.quantity} x {line.display_name}")
+
+    return "\n\n".join(order)
+
+
+# Generate a response for the context, as a stream of text chunks if requested. For streams, the
+# generation stage also counts the time spent waiting for each chunk while the caller consumes it
+def generate_response(context, stream=False, timer=None, intent="unknown_intent"):
+    timer = timer or MessageTimer()
+    with timer.span("generate_conversational_response"):
+        if not stream:
+            return generate_conversational_response(context, intent)
+        chunks = stream_conversational_response(context, intent)
+    return timer.timed_iter("generate_conversational_response", chunks)
+
+# Chatbot logic. Returns the response text, or an iterator of text chunks when stream is True
+# and the response is generated by the model.
+# Stage timings are recorded on timer. Without one, handle_message records its own and reports them
+# when the response is complete; a caller passing a timer calls timer.finish(session.last_intent) itself
+def handle_message(session, user_input, stream=False, timer=None):
+    if timer is not None:
+        return _handle_message(session, user_input, stream, timer)
+
+    timer = MessageTimer()
+    response = _handle_message(session, user_input, stream, timer)
+    if isinstance(response, str):
+        timer.finish(session.last_intent)
+        return response
+    return _finish_after_stream(response, timer, session.last_intent)
+
+def _finish_after_stream(chunks, timer, intent):
+    yield from chunks
+    timer.finish(intent)
+
+def _handle_message(session, user_input, stream, timer):
+    with timer.span("simplify_sentence"):
+        simplified_input = user_input.replace("Let's", "").strip()
+        simplified_input = simplify_sentence(simplified_input)
+    with timer.span("detect_intent"):
+        intent = detect_intent(simplified_input)
+    session.last_intent = intent
+
+    if intent == 'add_item' or intent == 'remove_item':
+        with timer.span("parse_user_input"):
+            context = process_user_input(session, simplified_input)
+        response = generate_response(context, stream, timer, intent)
+    
+    elif intent == "get_price":
+        response = get_price(simplified_input)
+    elif intent == "get_description":
+        description = get_description(simplified_input)
+        if description:
+            response = description
+        else:
+            response = get_fixed_response("item_not_found")
+    elif intent == 'get_tacos':
+        response = show_tacos()
+    elif intent == 'get_burritos':
+        response = show_burritos()
+    elif intent == 'get_nachos':
+        response = show_nachos()
+    elif intent == 'get_bowls':
+        response = show_bowls()
+    elif intent == 'get_sides':
+        response = show_sides()
+    elif intent == 'get_drinks':
+        response = show_drinks()
+    elif intent == 'get_sauces':
+        response = show_sauces()
+    elif intent == 'get_dairy':
+        response = show_dairy()
+    elif intent == 'get_gluten_free':
+        response = show_gluten_free()
+    elif intent == 'get_menu':
+        response = show_menu()
+    
+    elif intent == 'ask_question':
+        context = f"The user asked: '{user_input}'"
+        response = generate_response(context, stream, timer, intent)
+
+    elif intent == "view_order":
+        if session.order:
+            response = f"Your current order is \n\n{print_order(session)}\n\nand your total is ${session.order.total}."
+        else:
+            response = get_fixed_response("empty_order")
+    
+    elif intent == 'complete_order':
+        if session.order:
+            context = f"The user has finished their order. The final order is {print_order(session)}."
+            # The cart is only cleared once the order is safely journaled
+            try:
+                with timer.span("journal_order"):
+                    order_id = journal_order(session)
+            except Exception:
+                logging.exception(f"Couldn't journal the order of session {session.session_id}")
+                response = get_fixed_response("order_failed")
+            else:
+                logging.info(f"Order {order_id} completed")
+                session.order.clear()
+                response = generate_response(context, stream, timer, intent)
+        else:
+            response = get_fixed_response("empty_order")
+
+    elif intent == 'cancel_order':
+        session.order.clear()
+        response = get_fixed_response("cancel_order")
+
+    else:
+        response = get_fixed_response("unknown_intent")
+
+    return response
@@ -0,0 +1,177 @@
+import argparse
+import io
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# torch: stock fp32 PyTorch. int8: PyTorch with dynamic int8 quantization of the linear layers (CPU only).
+# onnx: a graph exported once with optimum and run by ONNX Runtime (needs `pip install optimum[onnxruntime]`)
+BACKENDS = ("torch", "int8", "onnx")
+
+# Prompts used to measure throughput and to compare a backend's output against the fp32 model
+REPORT_PROMPTS = (
+    "You are a chatbot for a Taco Bell restaurant.\n\nThe user added 2 Crunchy Tacos to their order.",
+    "You are a chatbot for a Taco Bell restaurant.\n\nThe user asked for the price of a Chalupa Supreme.",
+    "You are a chatbot for a Taco Bell restaurant.\n\nThe user cancelled the entire order.",
+)
+
+
+def load_model(backend, model_name="gpt2"):
+    """
+    Loads the causal language model for an inference backend. Every backend supports model.generate().
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+
+    if backend == "onnx":
+        return _load_onnx(model_name)
+
+    from transformers import AutoModelForCausalLM
+    import torch
+
+    model = AutoModelForCausalLM.from_pretrained(model_name)
+    if backend == "int8":
+        return _quantize_dynamic(model)     # Quantized kernels only run on the CPU
+    return model.to("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _quantize_dynamic(model):
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    # GPT-2's attention and MLP projections are Conv1D modules, which dynamic quantization doesn't recognize,
+    # so swap them for the equivalent Linear layers first (Conv1D computes x @ W + b with W transposed)
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.nf)
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+                linear.bias = torch.nn.Parameter(child.bias.detach())
+                setattr(parent, name, linear)
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _load_onnx(model_name):
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise RuntimeError("The onnx inference backend needs optimum[onnxruntime] installed") from e
+
+    # Export the graph on the first boot and reuse it afterwards
+    export_dir = os.getenv("ONNX_MODEL_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx", model_name)
+    if os.path.exists(os.path.join(export_dir, "config.json")):
+        return ORTModelForCausalLM.from_pretrained(export_dir, use_cache=True)
+
+    model = ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True)
+    model.save_pretrained(export_dir)
+    logger.info("Exported %s to ONNX in %s", model_name, export_dir)
+    return model
+
+
+def model_memory_bytes(model):
+    """
+    The size of the model's weights: the serialized state dict for PyTorch models (which counts packed
+    int8 weights correctly), or the exported files for ONNX models.
+    """
+    import torch
+
+    if isinstance(model, torch.nn.Module):
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        return buffer.tell()
+
+    directory = getattr(model, "model_save_dir", None)
+    if directory is None:
+        return None
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory) for name in names if name.endswith((".onnx", ".onnx_data"))
+    )
+
+
+def greedy_tokens(tokenizer, model, prompt, max_new_tokens=32):
+    """
+    Greedily generates from the prompt and returns the new token ids, which are deterministic and so comparable across backends.
+    """
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    output = model.generate(
+        inputs["input_ids"],
+        attention_mask=inputs["attention_mask"],
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.eos_token_id,
+        do_sample=False,
+    )
+    return output[0, inputs["input_ids"].shape[1]:].tolist()
+
+
+def token_agreement(candidate, reference):
+    """
+    The fraction of the reference tokens the candidate reproduces before the two first diverge.
+    """
+    if not reference:
+        return 1.0
+    matching = 0
+    for candidate_token, reference_token in zip(candidate, reference):
+        if candidate_token != reference_token:
+            break
+        matching += 1
+    return matching / len(reference)
+
+
+def report_backend(backend, tokenizer, model, model_name="gpt2", parity=True, prompts=REPORT_PROMPTS):
+    """
+    Measures the loaded model's weight memory, greedy decoding throughput and, for backends other than
+    torch, its output parity with the fp32 model. Logs the results, exports them as metrics and returns them.
+    """
+    start = time.perf_counter()
+    outputs = [greedy_tokens(tokenizer, model, prompt) for prompt in prompts]
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "backend": backend,
+        "memory_bytes": model_memory_bytes(model),
+        "tokens_per_s": sum(len(output) for output in outputs) / elapsed if elapsed else None,
+        "parity": None,
+    }
+
+    # The fp32 model is only loaded for the comparison, and dropped again right after
+    if parity and backend != "torch":
+        reference_model = load_model("torch", model_name)
+        references = [greedy_tokens(tokenizer, reference_model, prompt) for prompt in prompts]
+        del reference_model
+        report["parity"] = sum(map(token_agreement, outputs, references)) / len(prompts)
+
+    logger.info(
+        "Inference backend %s: %s MB of weights, %.1f tokens/s, parity with fp32 %s",
+        backend,
+        "?" if report["memory_bytes"] is None else f"{report['memory_bytes'] / 2 ** 20:.0f}",
+        report["tokens_per_s"] or 0,
+        "not measured" if report["parity"] is None else f"{report['parity']:.0%}",
+    )
+    for gauge, key in ((metrics.model_memory_bytes, "memory_bytes"), (metrics.model_tokens_per_second, "tokens_per_s"), (metrics.model_parity, "parity")):
+        if report[key] is not None:
+            gauge.set(report[key], backend=backend)
+    return report
+
+
+# Compare the backends side by side, e.g. before switching INFERENCE_BACKEND on a node
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Report memory, throughput and fp32 parity for each inference backend.")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--model", default="gpt2")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    for backend in args.backends:
+        try:
+            report_backend(backend, tokenizer, load_model(backend, args.model), args.model)
+        except Exception:
+            logger.exception("Couldn't report on the %s backend", backend)
@@ -0,0 +1,87 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+
+class BatchScheduler:
+    """
+    Collects generation requests from concurrent sessions and runs them through the model as one batch.
+
+    The first request in a batch waits at most `max_wait` seconds for others to join, and a batch never holds
+    more than `max_batch_size` prompts. `run_batch` receives a list of prompts and returns one result per prompt.
+    Anything else that benefits from doing many requests' work at once (e.g. one fsync for many journal writes)
+    can be batched the same way, with `name` used for its worker thread and log messages.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait=0.01, name="generation"):
+        self._run_batch = run_batch
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, prompt):
+        """
+        Queues the prompt and returns a Future that resolves to its result.
+        """
+        future = Future()
+        self._queue.put((prompt, future))
+
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-batcher", daemon=True)
+                self._worker.start()
+        return future
+
+    def generate(self, prompt, timeout=None):
+        """
+        Blocks until the prompt's batch has been generated and returns its result.
+
+        Raises concurrent.futures.TimeoutError if that takes longer than timeout seconds. A prompt that times
+        out before its batch starts is dropped from the queue.
+        """
+        # Batching disabled, run the prompt on the caller's thread (which can't be interrupted, so there's no timeout)
+        if self.max_batch_size <= 1:
+            return self._run_batch([prompt])[0]
+
+        future = self.submit(prompt)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Skip prompts whose callers already gave up on them
+            batch = [(prompt, future) for prompt, future in self._collect_batch() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            prompts = [prompt for prompt, _ in batch]
+            try:
+                results = self._run_batch(prompts)
+            except Exception as e:
+                logging.exception(f"Batched {self.name} of {len(prompts)} requests failed")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
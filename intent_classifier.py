@@ -0,0 +1,93 @@
+class IntentClassifier:
+    """
+    Keyword intent classifier backed by a prebuilt keyword -> [(intent, weight)] hash index.
+
+    Every keyword in the input adds its weight to its intent's score (one dict lookup per token, plus one
+    per adjacent token pair for phrase keywords such as "do you", which can carry negative weights).
+    The highest-scoring intent wins and ties go to the intent listed first in `priority`. Inputs without
+    a positively scored intent are 'unknown_intent'.
+    """
+
+    unknown = 'unknown_intent'
+
+    def __init__(self, intents, priority, keyword_weights=None, phrase_weights=None):
+        """
+        intents: {intent: [keyword, ...]}, each keyword weighing 1 unless overridden in keyword_weights
+        priority: intents from highest to lowest priority, used to break ties
+        keyword_weights: {keyword: weight}
+        phrase_weights: {(word, next word): (intent, weight)}
+        """
+        keyword_weights = keyword_weights or {}
+        self.intents = list(intents)
+        self._rank = {intent: rank for rank, intent in enumerate(reversed(priority))}    # Higher is stronger
+
+        self._index = {}
+        for intent, keywords in intents.items():
+            for keyword in keywords:
+                self._index.setdefault(keyword, []).append((intent, keyword_weights.get(keyword, 1.0)))
+
+        self._phrase_index = {}
+        for phrase, (intent, weight) in (phrase_weights or {}).items():
+            self._phrase_index.setdefault(tuple(phrase), []).append((intent, weight))
+
+    def scores(self, text):
+        """
+        Returns {intent: score} for the intents with at least one keyword in the text.
+        """
+        scores = {}
+        words = text.split()
+        for word in words:
+            for intent, weight in self._index.get(word, ()):
+                scores[intent] = scores.get(intent, 0.0) + weight
+
+        if self._phrase_index:
+            for phrase in zip(words, words[1:]):
+                for intent, weight in self._phrase_index.get(phrase, ()):
+                    scores[intent] = scores.get(intent, 0.0) + weight
+        return scores
+
+    def classify(self, text):
+        scores = self.scores(text)
+        if not scores:
+            return self.unknown
+
+        best = max(scores, key=lambda intent: (scores[intent], self._rank.get(intent, -1)))
+        return best if scores[best] > 0 else self.unknown
+
+    def classify_batch(self, texts):
+        """
+        Classifies many texts at once (e.g. logged utterances for offline analytics) as a bag-of-words
+        count matrix times an intent weight matrix in NumPy. Gives the same results as classify().
+        """
+        import numpy as np
+
+        vocabulary = {key: column for column, key in enumerate(list(self._index) + list(self._phrase_index))}
+        weights = np.zeros((len(vocabulary), len(self.intents)))
+        intent_columns = {intent: column for column, intent in enumerate(self.intents)}
+        for key, column in vocabulary.items():
+            entries = self._index.get(key, ()) if isinstance(key, str) else self._phrase_index[key]
+            for intent, weight in entries:
+                weights[column, intent_columns[intent]] += weight
+
+        counts = np.zeros((len(texts), len(vocabulary)))
+        matched = np.zeros((len(texts), len(self.intents)), dtype=bool)
+        for row, text in enumerate(texts):
+            words = text.split()
+            for key in words + list(zip(words, words[1:])):
+                column = vocabulary.get(key)
+                if column is not None:
+                    counts[row, column] += 1
+                    matched[row] |= weights[column] != 0
+
+        scores = counts @ weights
+        # Break ties by priority, then pick the best intent per row among the intents that were mentioned
+        ranks = np.array([self._rank.get(intent, -1) for intent in self.intents])
+        keyed = np.where(matched, scores, -np.inf)
+        best_score = keyed.max(axis=1, initial=-np.inf)
+        is_best = np.isclose(keyed, best_score[:, None]) & matched
+        best = np.where(is_best, ranks, -np.inf).argmax(axis=1)
+
+        return [
+            self.intents[column] if matched[row].any() and best_score[row] > 0 else self.unknown
+            for row, column in enumerate(best)
+        ]
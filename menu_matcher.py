@@ -0,0 +1,249 @@
+import math
+import re
+from collections import deque
+
+
+_lemma_token = re.compile(r"[a-z0-9']+|[^\sa-z0-9']")
+
+
+def _singular(word):
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("oes"):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us")) and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def lemma_form(name):
+    """
+    Roughly how a menu name reads in lemmatized input: "Black Beans and Rice" -> "black bean and rice",
+    "Beefy 5-Layer Burrito" -> "beefy 5 - layer burrito".
+    """
+    return " ".join(_singular(token) for token in _lemma_token.findall(name.lower()))
+
+
+class MenuMatcher:
+    """
+    Aho-Corasick automaton over the lowercased menu item names.
+
+    The automaton is built once from the menu and then finds every item mention in a single pass
+    over the input text, so matching cost depends on the length of the utterance rather than the
+    number of items on the menu. Like the original substring test, names can match anywhere in the text.
+    With lemma_forms, each name also matches in the form it takes in lemmatized input (see lemma_form).
+    """
+
+    def __init__(self, items, lemma_forms=False):
+        self._goto = [{}]       # state -> {char: next state}
+        self._fail = [0]        # state -> fallback state on mismatch
+        self._output = [None]   # state -> (name length, item) for the name ending at this state
+        self._dict_link = [0]   # state -> nearest fallback state that ends a name
+
+        items = list(items)
+        for item in items:
+            self._add(item["name"].lower(), item)
+        # After every exact name, so a name in lemma form never shadows another item's exact name
+        if lemma_forms:
+            for item in items:
+                self._add(lemma_form(item["name"]), item)
+        self._build_links()
+
+    def _add(self, name, item):
+        if not name:
+            return
+        state = 0
+        for char in name:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._dict_link.append(0)
+            state = next_state
+        # Keep the first item registered under a name, matching the old first-hit scan order
+        if self._output[state] is None:
+            self._output[state] = (len(name), item)
+
+    def _build_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                fail_state = self._fail[next_state]
+                self._dict_link[next_state] = fail_state if self._output[fail_state] else self._dict_link[fail_state]
+
+    def iter_matches(self, text):
+        """
+        Yields (start, end, item) for every menu name occurring in the lowercased text, including overlaps.
+        """
+        goto, fail, output, dict_link = self._goto, self._fail, self._output, self._dict_link
+        state = 0
+        for index, char in enumerate(text.lower()):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            match_state = state if output[state] else dict_link[state]
+            while match_state:
+                length, item = output[match_state]
+                yield index + 1 - length, index + 1, item
+                match_state = dict_link[match_state]
+
+    def find_all(self, text):
+        """
+        Returns the non-overlapping item mentions in the text from left to right as (start, end, item) tuples,
+        preferring the longest name wherever mentions overlap ("Cheesy Gordita Crunch" over "Crunch").
+        """
+        matches = sorted(self.iter_matches(text), key=lambda match: (match[0], match[0] - match[1]))
+        results = []
+        last_end = 0
+        for start, end, item in matches:
+            if start >= last_end:
+                results.append((start, end, item))
+                last_end = end
+        return results
+
+    def find(self, text):
+        """
+        Returns the menu item with the longest name mentioned in the text, or None if there is no mention.
+        """
+        best = None
+        best_length = 0
+        for start, end, item in self.iter_matches(text):
+            if end - start > best_length:
+                best, best_length = item, end - start
+        return best
+
+
+def edit_distance(a, b, limit=None):
+    """
+    Optimal string alignment distance: insertions, deletions, substitutions and swaps of adjacent characters
+    ("supreem" -> "supreme") each cost 1. Returns limit + 1 if the distance exceeds limit.
+    """
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        previous_previous, previous = previous, current
+    if limit is not None and previous[-1] > limit:
+        return limit + 1
+    return previous[-1]
+
+
+_word_pattern = re.compile(r"[a-z0-9]+")
+
+# Words that say nothing about which item is meant
+_stop_words = frozenset({"a", "an", "and", "the", "of", "with", "on", "in"})
+
+
+def _words(text):
+    return [word for word in _word_pattern.findall(text.lower()) if word not in _stop_words]
+
+
+def _ngrams(word, n):
+    padded = f"${word}$"
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+
+class FuzzyMenuMatcher:
+    """
+    Finds menu items mentioned with typos or partial names ("chalupa supreem", "crunchwrap").
+
+    Every distinct word of the menu names is indexed by its character n-grams, so a word of the input is only
+    compared (by edit distance) with the few name words it shares n-grams with. An item scores the share of its
+    name the input covers, with each name word weighted by how rare it is on the menu: "crunchwrap" alone
+    identifies Crunchwrap Supreme, while "supreme" alone doesn't pick any of the supremes.
+    """
+
+    def __init__(self, items, threshold=0.6, word_similarity=0.75, n=3):
+        self.threshold = threshold
+        self.word_similarity = word_similarity
+        self.n = n
+
+        self._items = []
+        self._name_words = []       # item index -> distinct words of its name
+        self._word_items = {}       # name word -> indexes of the items whose names contain it
+        seen = set()
+        for item in items:
+            name = item["name"].lower()
+            if name in seen or not _words(name):
+                continue
+            seen.add(name)
+            words = tuple(dict.fromkeys(_words(name)))
+            for word in words:
+                self._word_items.setdefault(word, []).append(len(self._items))
+            self._items.append(item)
+            self._name_words.append(words)
+
+        self._idf = {word: math.log(1 + len(self._items) / len(indexes)) for word, indexes in self._word_items.items()}
+        self._ngram_index = {}      # n-gram -> name words containing it
+        for word in self._word_items:
+            for gram in _ngrams(word, n):
+                self._ngram_index.setdefault(gram, []).append(word)
+
+    def _similar_words(self, word):
+        """
+        Returns {name word: similarity} for the name words close enough to a word of the input.
+        """
+        grams = _ngrams(word, self.n)
+        shared = {}
+        for gram in grams:
+            for candidate in self._ngram_index.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        similar = {}
+        for candidate, count in shared.items():
+            # Words sharing too few n-grams can't be within the allowed edit distance
+            if count * 3 < len(grams):
+                continue
+            longest = max(len(word), len(candidate))
+            limit = int(longest * (1 - self.word_similarity))
+            distance = edit_distance(word, candidate, limit)
+            if distance <= limit:
+                similar[candidate] = 1 - distance / longest
+        return similar
+
+    def search(self, text, limit=3):
+        """
+        Returns up to limit (item, score) pairs for the items the text most likely mentions, best first.
+        Scores range from 0 to 1, where 1 means every word of the item's name appears in the text.
+        """
+        matched = {}    # name word -> best similarity to any word of the text
+        for word in set(_words(text)):
+            for name_word, similarity in self._similar_words(word).items():
+                if similarity > matched.get(name_word, 0):
+                    matched[name_word] = similarity
+
+        candidates = {index for name_word in matched for index in self._word_items[name_word]}
+        ranked = []
+        for index in candidates:
+            words = self._name_words[index]
+            total = sum(self._idf[word] for word in words)
+            score = sum(self._idf[word] * matched.get(word, 0) for word in words) / total
+            ranked.append((-score, -len(words), index))    # Ties go to the name covering more words, then menu order
+        ranked.sort()
+        return [(self._items[index], -score) for score, _, index in ranked[:limit]]
+
+    def find(self, text):
+        """
+        Returns the best matching item if its score reaches the threshold, otherwise None.
+        """
+        results = self.search(text, limit=1)
+        if results and results[0][1] >= self.threshold:
+            return results[0][0]
+        return None
@@ -0,0 +1,383 @@
+import logging
+import os
+import threading
+import time
+
+from menu_matcher import FuzzyMenuMatcher, MenuMatcher
+from modifications import ModificationEngine
+
+
+class MenuSnapshot:
+    """
+    Immutable view of the menu at one version.
+
+    Anything derived from the menu (name index, tag index, rendered listings, ...) is built on first use and
+    cached on the snapshot, so it's computed once per menu version and dropped along with the old snapshot
+    when the menu changes.
+    """
+
+    def __init__(self, items, version):
+        self.items = tuple(items)
+        self.version = version
+        self._cache = {}
+        # Reentrant, since builds use other cached values (listings use the tag index, the menu page the listings)
+        self._lock = threading.RLock()
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def cached(self, key, build):
+        """
+        Returns the value cached under key for this menu version, calling build() the first time.
+        """
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = build()
+            return self._cache[key]
+
+    @property
+    def matcher(self):
+        # Input is lemmatized before matching, so names are also matched in their lemmatized form
+        return self.cached("matcher", lambda: MenuMatcher(self.items, lemma_forms=True))
+
+    @property
+    def fuzzy_matcher(self):
+        return self.cached("fuzzy_matcher", lambda: FuzzyMenuMatcher(self.items))
+
+    @property
+    def modification_engine(self):
+        return self.cached("modification_engine", lambda: ModificationEngine(self.items))
+
+    @property
+    def tag_index(self):
+        """
+        Inverted index from each tag to the items carrying it, in menu order.
+        """
+        return self.cached("tag_index", self._build_tag_index)
+
+    def _build_tag_index(self):
+        index = {}
+        for item in self.items:
+            for tag in dict.fromkeys(item.get("tags", ())):   # Skip duplicate tags on the same item
+                index.setdefault(tag, []).append(item)
+        return {tag: tuple(items) for tag, items in index.items()}
+
+    def with_tag(self, tag):
+        return self.tag_index.get(tag, ())
+
+    def without_tag(self, tag):
+        tagged = {id(item) for item in self.with_tag(tag)}
+        return tuple(item for item in self.items if id(item) not in tagged)
+
+
+class MenuStore:
+    """
+    Keeps the current MenuSnapshot in sync with the menu collection without restarting the process.
+
+    The whole collection is read once by load(). After that only changed documents are fetched, either from a
+    MongoDB change stream or by polling for documents whose `version_field` (e.g. updated_at) is newer than
+    anything seen so far. Each batch of changes is applied to a private copy of the items and published as a
+    new snapshot with the next version number, so readers always see a complete, consistent menu.
+
+    Documents with `deleted: true` are removed from the menu, which lets polling pick up deletions too.
+
+    The change stream starts from the cluster time recorded before the last full read (or reconcile), and
+    resumes after the last change it applied when it's reopened, so no change falls between a read and the
+    stream. A failed stream is retried with backoff, polling in the meantime.
+
+    `fields` limits every fetch to the fields the caller uses. With a `snapshot_path`, every published menu is
+    also written to that file, so the next process can start from it with load_snapshot() and only fetch what
+    changed since with reconcile(), instead of reading the whole collection.
+    """
+
+    # Bumped whenever the layout of the snapshot file changes, older files are then ignored
+    snapshot_format = 1
+
+    def __init__(self, collection, version_field="updated_at", poll_interval=30, fields=None, snapshot_path=None):
+        self._collection = collection
+        self.version_field = version_field
+        self.poll_interval = poll_interval
+        self.snapshot_path = snapshot_path
+        self._projection = None
+        if fields is not None:
+            self._projection = dict.fromkeys([*fields, version_field, "deleted"], 1)
+        self._items = {}
+        self._high_water = None     # Newest version_field value applied so far
+        self._start_at = None       # Cluster time of the last full read, where a new change stream starts
+        self._resume_token = None   # Resume token of the last change applied from the change stream
+        self._lock = threading.Lock()
+        self._thread = None
+        self.snapshot = MenuSnapshot((), version=0)
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def _find(self, query):
+        return self._collection.find(query, self._projection)
+
+    def _operation_time(self):
+        # None without a replica set (which change streams need anyway) or outside MongoDB
+        try:
+            return self._collection.database.client.admin.command("hello").get("operationTime")
+        except Exception:
+            return None
+
+    def _project(self, document):
+        if self._projection is None:
+            return document
+        return {key: value for key, value in document.items() if key == "_id" or key in self._projection}
+
+    def load(self):
+        """
+        Reads the whole collection and publishes it as the first snapshot.
+        """
+        start_at = self._operation_time()
+        with self._lock:
+            self._items = {}
+            self._high_water = None
+            self._apply(self._find({}))
+            self._publish()
+            self._start_at, self._resume_token = start_at, None
+        return self.snapshot
+
+    def _apply(self, documents):
+        for document in documents:
+            if document.get("deleted"):
+                self._items.pop(document["_id"], None)
+            else:
+                self._items[document["_id"]] = document
+
+            stamp = document.get(self.version_field)
+            if stamp is not None and (self._high_water is None or stamp > self._high_water):
+                self._high_water = stamp
+
+    def _publish(self):
+        self.snapshot = MenuSnapshot(self._items.values(), version=self.snapshot.version + 1)
+        if self.snapshot_path:
+            try:
+                self.save_snapshot()
+            except Exception:
+                logging.exception(f"Couldn't save the menu snapshot to {self.snapshot_path}")
+
+    def save_snapshot(self):
+        """
+        Writes the current items and high-water mark to snapshot_path as one BSON document, which keeps ObjectIds
+        and datetimes intact for later queries. The file is replaced atomically, so concurrent workers never read a partial one.
+        """
+        import bson
+
+        data = bson.encode({
+            "format": self.snapshot_format,
+            "saved_at": time.time(),
+            "high_water": self._high_water,
+            "items": list(self._items.values()),
+        })
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        """
+        Publishes the menu saved in snapshot_path, if there is a usable one. Returns whether it was loaded.
+        """
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+
+        import bson
+
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                data = bson.decode(f.read())
+        except Exception:
+            logging.warning(f"Ignoring unreadable menu snapshot {self.snapshot_path}", exc_info=True)
+            return False
+        if data.get("format") != self.snapshot_format:
+            return False
+
+        with self._lock:
+            self._items = {document["_id"]: document for document in data["items"]}
+            self._high_water = data["high_water"]
+            self.snapshot = MenuSnapshot(self._items.values(), version=self.snapshot.version + 1)
+        return True
+
+    def reconcile(self):
+        """
+        Brings a menu loaded from a snapshot up to date: fetches the documents changed since the snapshot, and
+        the ids of all documents to drop any deleted outright. Without a high-water mark it reads everything again.
+        Returns whether the menu changed.
+        """
+        if self._high_water is None:
+            before = {_id: document for _id, document in self._items.items()}
+            self.load()
+            return before != self._items
+
+        start_at = self._operation_time()
+        changed = self.poll()
+        current_ids = {document["_id"] for document in self._collection.find({}, {"_id": 1})}
+        removed = [_id for _id in self._items if _id not in current_ids]
+        changed = self.apply_changes((), deleted_ids=removed) or changed
+        self._start_at, self._resume_token = start_at, None
+        return changed
+
+    def apply_changes(self, documents, deleted_ids=()):
+        """
+        Applies changed documents and deleted ids, publishing a new snapshot if anything changed.
+        """
+        documents = [self._project(document) for document in documents]
+        if not documents and not deleted_ids:
+            return False
+
+        with self._lock:
+            self._apply(documents)
+            for _id in deleted_ids:
+                self._items.pop(_id, None)
+            self._publish()
+        return True
+
+    def poll(self):
+        """
+        Fetches documents changed since the last one seen and applies them. Returns whether the menu changed.
+        """
+        if self._high_water is None:
+            query = {self.version_field: {"$exists": True}}
+        else:
+            query = {self.version_field: {"$gt": self._high_water}}
+        return self.apply_changes(self._find(query))
+
+    def watch(self):
+        """
+        Applies changes from a MongoDB change stream as they happen. Blocks until the stream fails.
+        """
+        options = {"full_document": "updateLookup"}
+        if self._resume_token is not None:
+            options["resume_after"] = self._resume_token
+        elif self._start_at is not None:
+            options["start_at_operation_time"] = self._start_at
+
+        try:
+            with self._collection.watch(**options) as stream:
+                if len(options) == 1:
+                    # Nowhere to start the stream from, so read everything once it's open instead
+                    self.load()
+                for change in stream:
+                    if change["operationType"] == "delete":
+                        self.apply_changes((), deleted_ids=[change["documentKey"]["_id"]])
+                    elif change.get("fullDocument"):
+                        self.apply_changes([change["fullDocument"]])
+                    self._resume_token = stream.resume_token
+        except Exception as e:
+            # The oplog no longer reaches back to the resume point, start over from a full read
+            if getattr(e, "code", None) in (280, 286):    # ChangeStreamFatalError, ChangeStreamHistoryLost
+                self._start_at = self._resume_token = None
+            raise
+
+    def start(self, mode="watch", reconcile=False, max_retry_interval=600):
+        """
+        Starts syncing in a daemon thread. "watch" uses a change stream, polling while it's unavailable
+        (change streams need a replica set) and retrying it with backoff up to max_retry_interval seconds.
+        "poll" only polls, and "off" disables syncing. With reconcile, the thread first brings a menu loaded
+        from a snapshot up to date.
+        """
+        if self._thread is not None or (mode == "off" and not reconcile):
+            return
+
+        def sync():
+            if reconcile:
+                try:
+                    if self.reconcile():
+                        logging.info(f"Menu snapshot reconciled, now at version {self.version}")
+                except Exception:
+                    logging.exception("Reconciling the menu snapshot failed, serving it until the next poll")
+            if mode == "off":
+                return
+
+            retry_interval = self.poll_interval
+            next_watch = time.monotonic() if mode == "watch" else None
+            while True:
+                if next_watch is not None and time.monotonic() >= next_watch:
+                    started = time.monotonic()
+                    try:
+                        self.watch()
+                        error = None
+                    except Exception as e:
+                        error = e
+                    # Back off while the stream keeps failing, start over once it has been up for a while
+                    if time.monotonic() - started > retry_interval:
+                        retry_interval = self.poll_interval
+                    logging.warning(f"Menu change stream closed, polling for menu changes until it's reopened in {retry_interval:.0f}s", exc_info=error)
+                    next_watch = time.monotonic() + retry_interval
+                    retry_interval = min(retry_interval * 2, max_retry_interval)
+
+                time.sleep(self.poll_interval)
+                try:
+                    if self.poll():
+                        logging.info(f"Menu updated to version {self.version}")
+                except Exception:
+                    logging.exception("Polling for menu changes failed")
+
+        self._thread = threading.Thread(target=sync, name="menu-sync", daemon=True)
+        self._thread.start()
+
+
+class InMemoryCollection:
+    """
+    Minimal stand-in for a pymongo collection, for running the menu store without MongoDB
+    (local development, tests and benchmarks). Supports equality, $gt and $exists filters on top-level fields.
+    """
+
+    def __init__(self, documents=()):
+        self._documents = {}
+        for document in documents:
+            self.insert_one(document)
+
+    def find(self, filter=None, projection=None):
+        documents = [dict(document) for document in self._documents.values() if self._matches(document, filter or {})]
+        if projection:
+            fields = {field for field, include in projection.items() if include} | {"_id"}
+            documents = [{key: value for key, value in document.items() if key in fields} for document in documents]
+        return iter(documents)
+
+    def insert_one(self, document):
+        document = dict(document)
+        document.setdefault("_id", len(self._documents) + 1)
+        self._documents[document["_id"]] = document
+        return document["_id"]
+
+    def update_one(self, filter, update):
+        for document in self._documents.values():
+            if self._matches(document, filter):
+                document.update(update.get("$set", {}))
+                return True
+        return False
+
+    def delete_one(self, filter):
+        for _id, document in list(self._documents.items()):
+            if self._matches(document, filter):
+                del self._documents[_id]
+                return True
+        return False
+
+    def watch(self, *args, **kwargs):
+        raise NotImplementedError("InMemoryCollection does not support change streams")
+
+    @staticmethod
+    def _matches(document, filter):
+        for field, condition in filter.items():
+            if isinstance(condition, dict):
+                if "$exists" in condition and (field in document) != condition["$exists"]:
+                    return False
+                if "$gt" in condition and not (field in document and document[field] > condition["$gt"]):
+                    return False
+            elif document.get(field) != condition:
+                return False
+        return True
@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from regex-parsing fast to GPT-2 slow
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Size buckets in bytes, from a few short messages to several menu listings
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 131072, 262144, 524288, 1048576)
+
+logger = logging.getLogger("chatbot.metrics")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def expose(self):
+        lines = super().expose()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series = {}   # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+# Every metric exported on /metrics, in registration order
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+messages_total = register(Counter("chatbot_messages_total", "Messages handled, by detected intent."))
+stage_seconds = register(Histogram("chatbot_stage_seconds", "Time spent in each stage of handling a message, by stage and intent."))
+message_seconds = register(Histogram("chatbot_message_seconds", "Total time to handle a message, by intent."))
+generation_fallbacks = register(Counter("chatbot_generation_fallbacks_total", "Generated responses replaced by a template response, by intent and reason (deadline, error, or empty_pool for a fixed response not pre-generated yet)."))
+model_memory_bytes = register(Gauge("chatbot_model_memory_bytes", "Size of the language model's weights, by inference backend."))
+model_tokens_per_second = register(Gauge("chatbot_model_tokens_per_second", "Greedy decoding throughput measured at startup, by inference backend."))
+model_parity = register(Gauge("chatbot_model_parity", "Agreement of the backend's greedy output with the fp32 model at startup, from 0 to 1."))
+orders_journaled = register(Counter("chatbot_orders_journaled_total", "Completed orders written durably to the order journal."))
+orders_shipped = register(Counter("chatbot_orders_shipped_total", "Journaled orders inserted into the MongoDB orders collection."))
+order_journal_backlog_bytes = register(Gauge("chatbot_order_journal_backlog_bytes", "Size of the journaled orders not yet shipped to MongoDB."))
+chat_history_bytes = register(Histogram("chatbot_chat_history_bytes", "Memory held by a session's recent chat turns, observed after each message.", buckets=SIZE_BUCKETS))
+chat_history_budget_bytes = register(Gauge("chatbot_chat_history_budget_bytes", "Most memory a session's recent chat turns may hold before older ones move to the history store."))
+chat_turns_spilled = register(Counter("chatbot_chat_turns_spilled_total", "Chat turns moved out of memory to the history store."))
+
+
+def expose():
+    """
+    Returns all registered metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+class MessageTimer:
+    """
+    Collects timing spans for the stages of one message. The intent is only known part-way through
+    handling a message, so spans are recorded together once finish() is called with it.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.finished = False
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def timed_iter(self, stage, iterator):
+        """
+        Wraps a lazy iterator (e.g. a streamed response) so the time spent producing each item counts towards stage.
+        """
+        iterator = iter(iterator)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield item
+
+    def finish(self, intent):
+        if self.finished:
+            return
+        self.finished = True
+
+        total = time.perf_counter() - self.started
+        messages_total.inc(intent=intent)
+        message_seconds.observe(total, intent=intent)
+        for stage, seconds in self.stages.items():
+            stage_seconds.observe(seconds, stage=stage, intent=intent)
+
+        logger.info(json.dumps({
+            "event": "message_handled",
+            "intent": intent,
+            "total_ms": round(total * 1000, 3),
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+        }))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # Scrapes would otherwise flood the log
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serves /metrics on a local port from a daemon thread and returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,223 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Messages are UTF-8 JSON objects, each prefixed with its length as a 4-byte big-endian integer
+_HEADER = struct.Struct(">I")
+
+
+def send_message(sock, message):
+    body = json.dumps(message).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+def recv_message(sock):
+    """
+    Reads one message, or returns None if the other side closed the connection between messages.
+    """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    body = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    if body is None:
+        raise ConnectionError("Connection closed in the middle of a message")
+    return json.loads(body)
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError("Connection closed in the middle of a message")
+            return None
+        data += chunk
+    return data
+
+
+class ModelServerError(RuntimeError):
+    pass
+
+
+class ModelClient:
+    """
+    Client for a model server process, which owns the GPT-2 and spaCy models for every process on the node.
+
+    Each thread keeps its own connection to the server's Unix socket, and a connection is dropped and
+    reopened on the next call whenever a request on it fails or times out.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, timeout):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        sock.settimeout(timeout or self.timeout)
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            self._local.sock = None
+            sock.close()
+
+    def _request(self, message, timeout=None):
+        sock = self._connection(timeout)
+        try:
+            send_message(sock, message)
+            response = recv_message(sock)
+        except BaseException:
+            # A late response would otherwise be read as the answer to the next request
+            self._close()
+            raise
+        if response is None:
+            self._close()
+            raise ConnectionError("The model server closed the connection")
+        if "error" in response:
+            raise ModelServerError(response["error"])
+        return response
+
+    def ping(self):
+        """
+        Returns the readiness of the server's models, e.g. {"language_model": "ready", ...}.
+        """
+        return self._request({"op": "ping"})["resources"]
+
+    def lemmatize(self, texts):
+        return self._request({"op": "lemmatize", "texts": list(texts)})["result"]
+
+    def generate(self, context, intent, deadline=None):
+        """
+        Generates a response on the server, which applies the deadline and template fallback itself.
+        Without a deadline the request may take as long as the client's timeout.
+        """
+        # Leave the server time to answer with its fallback before giving up on it
+        timeout = deadline + 1 if deadline is not None else None
+        message = {"op": "generate", "context": context, "intent": intent, "deadline": deadline}
+        return self._request(message, timeout)["result"]
+
+    def stream(self, context, intent, chunk_timeout=None):
+        """
+        Yields the response's text chunks as the server generates them.
+        """
+        sock = self._connection(chunk_timeout)
+        done = False
+        try:
+            send_message(sock, {"op": "stream", "context": context, "intent": intent})
+            while True:
+                response = recv_message(sock)
+                if response is None:
+                    raise ConnectionError("The model server closed the connection")
+                if "error" in response:
+                    done = True
+                    raise ModelServerError(response["error"])
+                if response.get("done"):
+                    done = True
+                    return
+                yield response["chunk"]
+        finally:
+            # Abandoned or failed streams leave unread chunks on the connection
+            if not done:
+                self._close()
+
+
+class _ModelRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        import chatbot_logic
+        from resources import readiness
+
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            if message is None:
+                return
+
+            try:
+                op = message.get("op")
+                if op == "ping":
+                    send_message(self.request, {"resources": readiness()})
+                elif op == "lemmatize":
+                    texts = message["texts"]
+                    # Single utterances go through the lemma cache, batches through nlp.pipe
+                    if len(texts) == 1:
+                        result = [chatbot_logic._lemmatize(texts[0].lower())]
+                    else:
+                        result = chatbot_logic.simplify_sentences(texts)
+                    send_message(self.request, {"result": result})
+                elif op == "generate":
+                    # Requests from every client process share the server's batched generation
+                    result = chatbot_logic.generate_conversational_response(message["context"], message["intent"], message["deadline"])
+                    send_message(self.request, {"result": result})
+                elif op == "stream":
+                    for chunk in chatbot_logic.stream_conversational_response(message["context"], message["intent"]):
+                        send_message(self.request, {"chunk": chunk})
+                    send_message(self.request, {"done": True})
+                else:
+                    send_message(self.request, {"error": f"Unknown op {op!r}"})
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                logger.exception("Model server request failed")
+                try:
+                    send_message(self.request, {"error": f"{type(e).__name__}: {e}"})
+                except OSError:
+                    return
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves lemmatization and response generation over a Unix socket, so processes on the same node
+    share one copy of the models instead of each loading their own.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        # A socket file left over from a server that didn't shut down cleanly would block the bind
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, _ModelRequestHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the chatbot's GPT-2 and spaCy models to other processes on this node.")
+    parser.add_argument("--socket", default=os.getenv("MODEL_SERVER_SOCKET") or "/tmp/tacobell-models.sock")
+    parser.add_argument("--metrics-port", type=int, help="serve the server's generation metrics on this port")
+    args = parser.parse_args()
+
+    # This process owns the models, so it must never become a client of itself
+    os.environ["MODEL_SERVER_SOCKET"] = ""
+
+    import chatbot_logic    # Registers the models' lazy resources
+    from metrics import start_metrics_server
+    from resources import warm_up
+
+    logging.basicConfig(level=logging.INFO)
+    warm_up(["spacy_model", "language_model", "prompt_cache"], background=False)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    with ModelServer(args.socket) as server:
+        logger.info("Serving models on %s", args.socket)
+        server.serve_forever()
@@ -0,0 +1,141 @@
+import re
+from collections import namedtuple
+
+# Words that end an ingredient phrase ("no sour cream and extra cheese" -> "sour cream", "cheese")
+_boundary_words = (
+    "and", "or", "but", "with", "for", "on", "in", "to", "please", "no", "without", "extra", "additional", "more",
+    "substitute", "swap", "replace",
+)
+_word = rf"(?!(?:{'|'.join(_boundary_words)})\b)[a-z][a-z0-9'-]*"
+_phrase = rf"{_word}(?:\s+{_word}){{0,3}}"
+
+# One pass over the command finds every modification. Substitutions come first, so "replace X with Y" isn't read
+# as anything else, and phrases are matched up to four words long, then narrowed down to a known ingredient
+_scanner = re.compile(
+    rf"\b(?:substitute|swap|replace)\s+(?:the\s+)?(?P<old>{_phrase})\s+(?:with|for)\s+(?:the\s+)?(?P<new>{_phrase})"
+    rf"|\b(?:no|without)\s+(?:the\s+)?(?P<remove>{_phrase})"
+    rf"|\b(?:extra|additional|more)\s+(?P<add>{_phrase})",
+    re.IGNORECASE,
+)
+
+_split_words = re.compile(r"[a-z0-9']+")
+
+
+def _normalize_word(word):
+    # Input is lemmatized ("tomato") while ingredient names are plain English ("tomatoes")
+    if word.endswith("oes"):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def _key(phrase):
+    return tuple(_normalize_word(word) for word in _split_words.findall(phrase.lower()))
+
+
+class Modification(namedtuple("Modification", ["action", "ingredient", "replacement"])):
+    """
+    One change to a menu item: ("remove", "sour cream", None), ("extra", "three-cheese blend", None) for more of an
+    ingredient the item has, ("add", "jalapenos", None) for one it doesn't, or ("substitute", "lettuce", "onion").
+    Converts to the text shown on the order, e.g. "no sour cream".
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, action, ingredient, replacement=None):
+        return super().__new__(cls, action, ingredient, replacement)
+
+    def __str__(self):
+        if self.action == "remove":
+            return f"no {self.ingredient}"
+        if self.action == "substitute":
+            return f"substitute {self.ingredient} with {self.replacement}"
+        return f"{self.action} {self.ingredient}"
+
+
+class IngredientSet:
+    """
+    An item's ingredients as a frozenset, with a lookup from what customers call them to their names: the full
+    name ("sour cream"), or any word that only one of the item's ingredients has ("cheese" for "three-cheese blend").
+    """
+
+    __slots__ = ("ingredients", "_aliases")
+
+    def __init__(self, ingredients):
+        self.ingredients = frozenset(ingredients)
+        self._aliases = {}
+        word_owners = {}
+        for ingredient in self.ingredients:
+            self._aliases[_key(ingredient)] = ingredient
+            for word in set(_key(ingredient)):
+                word_owners.setdefault(word, set()).add(ingredient)
+        for word, owners in word_owners.items():
+            if len(owners) == 1:
+                self._aliases.setdefault((word,), next(iter(owners)))
+
+    def __contains__(self, ingredient):
+        return ingredient in self.ingredients
+
+    def resolve(self, phrase):
+        """
+        Returns the ingredient named by the longest leading part of the phrase, or None.
+        """
+        key = _key(phrase)
+        for length in range(len(key), 0, -1):
+            ingredient = self._aliases.get(key[:length])
+            if ingredient is not None:
+                return ingredient
+        return None
+
+
+class ModificationEngine:
+    """
+    Finds modifications in order commands, checked against the ingredients of the ordered item.
+    Ingredient sets are built once per menu version for every item on the menu.
+    """
+
+    def __init__(self, items):
+        self._ingredients = {self._item_key(item): IngredientSet(item.get("ingredients", ())) for item in items}
+
+    @staticmethod
+    def _item_key(item):
+        return item.get("_id", item["name"])
+
+    def ingredients(self, item):
+        ingredient_set = self._ingredients.get(self._item_key(item))
+        if ingredient_set is None:
+            # Item from another menu version
+            ingredient_set = IngredientSet(item.get("ingredients", ()))
+        return ingredient_set
+
+    def detect(self, text, item):
+        """
+        Returns the Modifications in the text, in order and without duplicates. Removals and substitutions only
+        count for ingredients the item has.
+        """
+        ingredients = self.ingredients(item)
+        modifications = []
+        for match in _scanner.finditer(text):
+            if match.group("old"):
+                old = ingredients.resolve(match.group("old"))
+                if old is not None:
+                    modifications.append(Modification("substitute", old, match.group("new").lower()))
+            elif match.group("remove"):
+                ingredient = ingredients.resolve(match.group("remove"))
+                if ingredient is not None:
+                    modifications.append(Modification("remove", ingredient))
+            else:
+                ingredient = ingredients.resolve(match.group("add"))
+                if ingredient is not None:
+                    modifications.append(Modification("extra", ingredient))
+                else:
+                    modifications.append(Modification("add", match.group("add").lower()))
+        return list(dict.fromkeys(modifications))
+
+    def starts_with_modification(self, text):
+        """
+        Whether the text opens with a modification, e.g. "extra cheese" split off from "... with no onions and extra cheese".
+        """
+        match = _scanner.search(text)
+        return match is not None and not text[:match.start()].strip()
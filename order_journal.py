@@ -0,0 +1,271 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import metrics
+from inference_batcher import BatchScheduler
+
+logger = logging.getLogger(__name__)
+
+# MongoDB's error code for an insert whose _id is already in the collection
+DUPLICATE_KEY = 11000
+
+_fsync = getattr(os, "fdatasync", os.fsync)
+
+
+# Length of the file up to the end of its last complete record. A crash in the middle of a write can leave
+# a torn record at the end, which was never acknowledged and is dropped
+def _complete_size(fd, size, chunk_size=65536):
+    end = size
+    while end > 0:
+        start = max(0, end - chunk_size)
+        newline = os.pread(fd, end - start, start).rfind(b"\n")
+        if newline != -1:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+class _Segment:
+    """
+    One journal file, locked by the process writing or draining it, and its checkpoint: the offset up to which
+    its records are known to be in MongoDB. Raises BlockingIOError if another process holds the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The file may have been drained and deleted between opening and locking it
+            if os.fstat(self.fd).st_ino != os.stat(path).st_ino:
+                raise BlockingIOError(f"{path} was replaced")
+        except OSError:
+            os.close(self.fd)
+            raise
+
+        size = os.fstat(self.fd).st_size
+        self.size = _complete_size(self.fd, size)
+        if self.size < size:
+            logger.warning(f"Dropping {size - self.size} bytes of a torn record at the end of {path}")
+            os.ftruncate(self.fd, self.size)
+        self.checkpoint = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                checkpoint = int(f.read())
+        except (OSError, ValueError):
+            return 0
+        # A checkpoint past the end means the file was compacted before the checkpoint was reset, so the
+        # records in it are new and shipped from the start
+        return checkpoint if checkpoint <= self.size else 0
+
+    def save_checkpoint(self, checkpoint):
+        # Not fsynced: a lost checkpoint only means shipping records again, which skips them as duplicates
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(checkpoint))
+        os.replace(tmp_path, self.checkpoint_path)
+        self.checkpoint = checkpoint
+
+    @property
+    def pending(self):
+        return self.size - self.checkpoint
+
+    def read(self, limit):
+        """
+        Returns the complete records after the checkpoint, about limit bytes of them, and the offset after the last one.
+        """
+        size = self.size
+        data = os.pread(self.fd, min(size - self.checkpoint, limit), self.checkpoint)
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            # A single record longer than the limit
+            data = os.pread(self.fd, size - self.checkpoint, self.checkpoint)
+            end = data.find(b"\n") + 1
+        return data[:end].splitlines(), self.checkpoint + end
+
+    def remove(self):
+        os.unlink(self.path)
+        try:
+            os.unlink(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+
+
+class OrderJournal:
+    """
+    Durable record of completed orders, shipped to MongoDB in the background.
+
+    append() writes the order to an append-only journal file and returns once it's on disk. Appends from
+    concurrent sessions are written and fsynced together (group commit), so one fsync covers a whole batch of
+    orders. A background thread ships journaled orders to the orders collection with insert_many and checkpoints
+    how far it got. While MongoDB is down, orders keep being journaled and are shipped when it's back.
+
+    Each order's id is its _id in the collection, so orders shipped again after a restart (inserted, but not yet
+    checkpointed) are skipped as duplicates and replay never creates a second copy.
+
+    Every process journals to its own file in `directory`, claimed with a file lock. Files of processes that
+    stopped are drained by the next shipper to find them, then deleted. `collection` is a function returning
+    the orders collection, called from the shipping thread. Without one, orders are only journaled.
+    """
+
+    def __init__(self, directory, collection=None, max_batch_size=64, max_wait=0.002, ship_interval=1,
+                 ship_bytes=1 << 20, max_bytes=64 << 20):
+        self.directory = directory
+        self._collection = collection
+        self.ship_interval = ship_interval
+        self.ship_bytes = ship_bytes
+        self.max_bytes = max_bytes      # The journal is emptied once everything in it is shipped and it's this large
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._orphans = {}
+        self._scheduler = BatchScheduler(self._commit, max_batch_size, max_wait, name="order-journal")
+
+        os.makedirs(directory, exist_ok=True)
+        self._segment = self._claim()
+
+    def _claim(self):
+        n = 0
+        while True:
+            try:
+                return _Segment(os.path.join(self.directory, f"orders-{n}.journal"))
+            except (BlockingIOError, FileNotFoundError):
+                n += 1
+
+    def _claim_orphans(self):
+        for path in sorted(glob.glob(os.path.join(self.directory, "orders-*.journal"))):
+            if path == self._segment.path or path in self._orphans:
+                continue
+            try:
+                self._orphans[path] = _Segment(path)
+            except (BlockingIOError, FileNotFoundError):
+                continue
+            logger.info(f"Draining the order journal {path} left by a stopped process")
+
+    def append(self, order, session_id=None):
+        """
+        Journals the order (a dict, e.g. Order.to_dict()) and returns its id once it's durable on disk.
+        Raises OSError if it couldn't be written, in which case it isn't journaled.
+        """
+        record = {"_id": uuid.uuid4().hex, "session_id": session_id, "completed_at": time.time(), **order}
+        self._scheduler.generate((json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+        metrics.orders_journaled.inc()
+        return record["_id"]
+
+    def _commit(self, records):
+        data = b"".join(records)
+        with self._lock:
+            segment = self._segment
+            try:
+                written = 0
+                while written < len(data):
+                    written += os.write(segment.fd, data[written:])
+                _fsync(segment.fd)
+            except OSError:
+                # Cut off whatever part of the batch made it into the file, so later records don't follow a torn one
+                os.ftruncate(segment.fd, segment.size)
+                raise
+            segment.size += len(data)
+        return [None] * len(records)
+
+    def start(self):
+        """
+        Starts shipping in a daemon thread, beginning with anything journaled but not shipped before a restart.
+        """
+        if self._thread is not None:
+            return
+        if self._collection is None:
+            logger.info("No orders collection configured, completed orders are only journaled locally")
+            return
+        self._thread = threading.Thread(target=self._ship_forever, name="order-shipper", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stops the shipping thread, leaving anything unshipped in the journal for the next process.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _ship_forever(self):
+        delay = 0
+        failing = False
+        while not self._stop.wait(delay):
+            try:
+                self.ship()
+            except Exception:
+                # Keep journaling and retry with backoff, logging each outage once
+                if not failing:
+                    logger.warning("Shipping orders to MongoDB failed, they stay journaled until it's reachable", exc_info=True)
+                failing = True
+                delay = min(max(delay, self.ship_interval) * 2, 60)
+            else:
+                if failing:
+                    logger.info("Shipping journaled orders to MongoDB again")
+                failing = False
+                delay = self.ship_interval
+            metrics.order_journal_backlog_bytes.set(self._segment.pending + sum(segment.pending for segment in self._orphans.values()))
+
+    def ship(self):
+        """
+        Ships every journaled order that isn't in MongoDB yet, including those in files of stopped processes.
+        """
+        collection = self._collection()
+        self._claim_orphans()
+        self._ship_segment(self._segment, collection)
+        for path, segment in list(self._orphans.items()):
+            self._ship_segment(segment, collection)
+            segment.remove()
+            del self._orphans[path]
+        self._compact()
+
+    def _ship_segment(self, segment, collection):
+        while segment.pending > 0:
+            lines, end = segment.read(self.ship_bytes)
+            documents = []
+            for line in lines:
+                try:
+                    document = json.loads(line)
+                except ValueError:
+                    logger.error(f"Skipping an unreadable record in {segment.path}: {line[:200]!r}")
+                    continue
+                document["completed_at"] = datetime.fromtimestamp(document["completed_at"], timezone.utc)
+                documents.append(document)
+            if documents:
+                self._insert(collection, documents)
+                metrics.orders_shipped.inc(len(documents))
+            segment.save_checkpoint(end)
+
+    @staticmethod
+    def _insert(collection, documents):
+        try:
+            collection.insert_many(documents, ordered=False)
+        except Exception as e:
+            # Orders already inserted before a crash or restart are expected, anything else isn't
+            details = getattr(e, "details", None) or {}
+            errors = details.get("writeErrors")
+            if not errors or details.get("writeConcernErrors") or any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+
+    def _compact(self):
+        with self._lock:
+            segment = self._segment
+            if segment.pending or segment.size < self.max_bytes:
+                return
+            os.ftruncate(segment.fd, 0)
+            _fsync(segment.fd)
+            segment.size = 0
+            # Before any new record, which the old checkpoint would otherwise skip after a crash
+            segment.save_checkpoint(0)
@@ -0,0 +1,127 @@
+import re
+from collections import namedtuple
+
+# A single command within an utterance, e.g. "two large baja blasts" in "add a taco and two large baja blasts"
+Command = namedtuple("Command", ["text", "intent_word", "quantity", "size", "item_text"])
+
+small_numbers = {
+    'zero': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8,
+    'nine': 9, 'ten': 10, 'eleven': 11, 'twelve': 12, 'thirteen': 13, 'fourteen': 14, 'fifteen': 15,
+    'sixteen': 16, 'seventeen': 17, 'eighteen': 18, 'nineteen': 19
+}
+tens = {
+    'twenty': 20, 'thirty': 30, 'forty': 40, 'fifty': 50, 'sixty': 60, 'seventy': 70, 'eighty': 80, 'ninety': 90
+}
+scales = {'hundred': 100, 'thousand': 1000, 'dozen': 12}
+collectives = {'couple': 2, 'pair': 2}
+
+size_keywords = ["small", "medium", "large"]
+
+
+def _alternation(words):
+    # Longest words first so "seventeen" is tried before "seven"
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+
+_number_word = r'(?:' + _alternation(list(small_numbers) + list(tens) + list(scales)) + r')\b'
+_number_joiner = r'(?:\s*-\s*|(?:(?<=hundred)|(?<=thousand))\s+and\s+|\s+)'
+_quantity_pattern = (
+    r'\d+\b'
+    r'|\b(?:a\s+)?' + _number_word + r'(?:' + _number_joiner + _number_word + r')*(?:\s+of\b)?'  # e.g. "one hundred and twenty", "a dozen"
+    r'|\b(?:a\s+)?(?:' + _alternation(collectives) + r')\b(?:\s+of\b)?'  # e.g. "a couple of"
+)
+
+
+def words_to_number(phrase):
+    """
+    Converts a quantity phrase such as "twenty-one", "a hundred and five", "two dozen" or "a couple of" to an integer.
+    """
+    if phrase.isdigit():
+        return int(phrase)
+
+    total = 0
+    current = 0
+    for word in re.findall(r"[a-z]+", phrase.lower()):
+        if word in small_numbers:
+            current += small_numbers[word]
+        elif word in tens:
+            current += tens[word]
+        elif word == "thousand":
+            total += max(current, 1) * scales[word]
+            current = 0
+        elif word in scales:
+            current = max(current, 1) * scales[word]
+        elif word in collectives:
+            current += collectives[word]
+        # Filler words like "a", "and" and "of" don't change the value
+    return total + current
+
+
+class OrderLexer:
+    """
+    Precompiled tokenizer that segments an order utterance into commands in one pass.
+
+    Commands are separated by delimiters (",", ";", "&", "and") and a quantity always starts a new command,
+    so "add two tacos and a large pepsi three nachos" becomes "add", "two tacos", "a large pepsi", "three nachos".
+    Within the spans of menu item names, every token is just part of the name, so "cheesy bean and rice burrito"
+    and "beefy 5 - layer burrito" stay whole.
+    """
+
+    def __init__(self, add_words, remove_words):
+        self._token_pattern = re.compile(
+            r'(?P<quantity>' + _quantity_pattern + r')'
+            r'|(?P<delim>[,;&]|\band\b)'
+            r'|(?P<size>\b(?:' + _alternation(size_keywords) + r')\b)'
+            r'|(?P<intent>\b(?:' + _alternation(list(add_words) + list(remove_words)) + r')\b)'
+            r'|(?P<word>\w+)',
+            re.IGNORECASE,
+        )
+
+    def split_commands(self, text, item_spans=()):
+        """
+        Returns the list of Commands in the text, skipping empty ones. item_spans are the (start, end) offsets
+        of the menu item names in the text, e.g. from MenuMatcher.find_all.
+        """
+        commands = []
+        start = 0
+        item_start = 0
+        intent_word = quantity = size = None
+        has_tokens = False
+
+        for match in self._token_pattern.finditer(text):
+            kind = match.lastgroup
+            if kind != "word" and any(start <= match.start() < end for start, end in item_spans):
+                kind = "word"
+
+            # A delimiter closes the current command, and a quantity starts a new one
+            if kind == "delim" or (kind == "quantity" and has_tokens):
+                if has_tokens:
+                    commands.append(self._command(text, start, match.start(), item_start, intent_word, quantity, size))
+                start = item_start = match.end() if kind == "delim" else match.start()
+                intent_word = quantity = size = None
+                has_tokens = False
+                if kind == "delim":
+                    continue
+
+            has_tokens = True
+            if kind == "quantity":
+                quantity = words_to_number(match.group())
+                item_start = match.end()
+            elif kind == "size" and size is None:
+                size = match.group().lower()
+            elif kind == "intent" and intent_word is None:
+                intent_word = match.group().lower()
+
+        if has_tokens:
+            commands.append(self._command(text, start, len(text), item_start, intent_word, quantity, size))
+        return commands
+
+    @staticmethod
+    def _command(text, start, end, item_start, intent_word, quantity, size):
+        return Command(
+            text=text[start:end].strip(),
+            intent_word=intent_word,
+            quantity=quantity,
+            size=size,
+            item_text=text[item_start:end].strip(),
+        )
@@ -0,0 +1,134 @@
+from decimal import Decimal
+
+
+# Convert a menu price in dollars (e.g. 1.99) to integer cents without float rounding errors
+def to_cents(price):
+    return int((Decimal(str(price)) * 100).quantize(Decimal(1)))
+
+# Format integer cents as a dollar amount, e.g. 1234 -> "12.34"
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+# The name shown to the user, e.g. "Large Baja Blast (no ice)"
+def format_item_name(name, size=None, modifications=()):
+    if size:
+        name = f"{size.capitalize()} {name}"
+    if modifications:
+        name += f" ({', '.join(modifications)})"
+    return name
+
+# Normalize modifications (text or structured Modifications) so the same changes in a different order or case share a line item
+def normalize_modifications(modifications):
+    return tuple(sorted({str(modification).strip().lower() for modification in modifications}))
+
+
+class LineItem:
+    """
+    One line of an order: a menu item with a size and set of modifications, and how many of it were ordered.
+    """
+
+    __slots__ = ("item_id", "name", "size", "modifications", "unit_price_cents", "quantity")
+
+    def __init__(self, item_id, name, size, modifications, unit_price_cents, quantity=0):
+        self.item_id = item_id
+        self.name = name
+        self.size = size
+        self.modifications = modifications
+        self.unit_price_cents = unit_price_cents
+        self.quantity = quantity
+
+    @property
+    def display_name(self):
+        """
+        The name shown to the user, built on demand rather than stored.
+        """
+        return format_item_name(self.name, self.size, self.modifications)
+
+    @property
+    def total_cents(self):
+        return self.unit_price_cents * self.quantity
+
+    def to_dict(self):
+        return {
+            "item_id": str(self.item_id),
+            "name": self.name,
+            "size": self.size,
+            "modifications": list(self.modifications),
+            "unit_price_cents": self.unit_price_cents,
+            "quantity": self.quantity,
+        }
+
+
+class Order:
+    """
+    A customer's order, with line items keyed by (item id, size, normalized modifications)
+    and a running total in integer cents.
+    """
+
+    __slots__ = ("_lines", "total_cents")
+
+    def __init__(self):
+        self._lines = {}
+        self.total_cents = 0
+
+    def __bool__(self):
+        return bool(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines.values())
+
+    @staticmethod
+    def _key(item, size, modifications):
+        return (item.get("_id", item["name"]), size, normalize_modifications(modifications))
+
+    def add(self, item, quantity, size=None, modifications=()):
+        """
+        Adds quantity of the menu item and returns its line item.
+        """
+        key = self._key(item, size, modifications)
+        line = self._lines.get(key)
+        if line is None:
+            line = LineItem(key[0], item["name"], size, key[2], to_cents(item["price"]))
+            self._lines[key] = line
+
+        line.quantity += quantity
+        self.total_cents += line.unit_price_cents * quantity
+        return line
+
+    def remove(self, item, quantity, size=None, modifications=()):
+        """
+        Removes up to quantity of the menu item and returns how many were actually removed.
+        """
+        key = self._key(item, size, modifications)
+        line = self._lines.get(key)
+        if line is None:
+            return 0
+
+        amount = min(quantity, line.quantity)  # Ensure not removing more than what's in the order
+        line.quantity -= amount
+        self.total_cents -= line.unit_price_cents * amount
+        # If the item count is zero, remove it from the order entirely
+        if line.quantity == 0:
+            del self._lines[key]
+        return amount
+
+    def clear(self):
+        self._lines.clear()
+        self.total_cents = 0
+
+    @property
+    def total(self):
+        """
+        The total as a dollar string, e.g. "12.34".
+        """
+        return format_cents(self.total_cents)
+
+    def to_dict(self):
+        return {
+            "lines": [line.to_dict() for line in self],
+            "total_cents": self.total_cents,
+        }
@@ -0,0 +1,78 @@
+import logging
+import threading
+
+# Registry of every lazy resource by name, in creation order
+registry = {}
+
+
+class LazyResource:
+    """
+    Handle for an expensive resource (model, database data, ...) that is loaded the first time it's used.
+
+    Loading is thread-safe, so a background warm-up thread and a request can both call get() and the
+    loader still only runs once. If the loader fails, the error is recorded and the next get() retries.
+    """
+
+    def __init__(self, name, loader, register=True):
+        self.name = name
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._value = None
+        self.state = "pending"  # pending -> loading -> ready, or failed
+        self.error = None
+        # Unregistered resources aren't warmed up or reported, e.g. models another process loads instead
+        if register:
+            registry[name] = self
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def get(self):
+        if self.state == "ready":
+            return self._value
+
+        with self._lock:
+            if self.state != "ready":
+                self.state = "loading"
+                try:
+                    self._value = self._loader()
+                except Exception as e:
+                    self.state = "failed"
+                    self.error = e
+                    raise
+                self.error = None
+                self.state = "ready"
+        return self._value
+
+
+def readiness():
+    """
+    Returns the state of every registered resource, e.g. {"menu": "ready", "language_model": "loading"}.
+    """
+    return {name: resource.state for name, resource in registry.items()}
+
+
+def warm_up(names=None, background=True):
+    """
+    Loads the named resources (all registered resources by default), in a daemon thread unless background is False.
+
+    Returns the thread so callers can join it, or None when loading in the foreground.
+    """
+    resources = [registry[name] for name in names] if names else list(registry.values())
+
+    def load_all():
+        for resource in resources:
+            try:
+                resource.get()
+                logging.info(f"Loaded {resource.name}")
+            except Exception:
+                logging.exception(f"Failed to load {resource.name}")
+
+    if not background:
+        load_all()
+        return None
+
+    thread = threading.Thread(target=load_all, name="resource-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+
+class ResponsePool:
+    """
+    Pool of pre-generated responses for contexts that never change (e.g. "The user cancelled the entire order.").
+
+    Each context keeps up to `size` sampled variants, which are saved to a JSON file so they survive restarts.
+    get() serves a random variant without running the model. A background worker tops up pools that aren't
+    full, and keeps full ones varied by replacing their oldest variant at most once every `rotate_interval`
+    seconds (never if it's None), so serving fixed responses doesn't cost a model pass per response.
+
+    While a context's pool is still empty (first boot, or a newly added context), get() answers with
+    `fallback(context)` and fills the pool in the background. Without a fallback it generates on the spot.
+    """
+
+    def __init__(self, generate, path, size=8, rotate_interval=600, fallback=None):
+        self._generate = generate   # context -> response text
+        self._fallback = fallback
+        self.path = path
+        self.size = size
+        self.rotate_interval = rotate_interval
+        self._refilled = {}         # context -> when a refill was last queued
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._pools = self._load()
+        self._pending = set()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.warning(f"Ignoring unreadable response pool at {self.path}")
+            return {}
+        return {context: list(variants)[-self.size:] for context, variants in data.items()}
+
+    def save(self):
+        with self._lock:
+            data = {context: list(variants) for context, variants in self._pools.items()}
+
+        # Write to a temporary file first so a crash never leaves a half-written pool behind
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError:
+            logging.exception(f"Failed to save response pool to {self.path}")
+
+    def available(self, context):
+        with self._lock:
+            return len(self._pools.get(context, ()))
+
+    def get(self, context):
+        """
+        Returns a random pre-generated response for the context, or the fallback response if the pool is empty.
+        """
+        with self._lock:
+            variants = self._pools.get(context)
+            response = random.choice(variants) if variants else None
+
+        if response is None:
+            if self._fallback is not None:
+                self.refill_async([context])
+                return self._fallback(context)
+            response = self._generate(context)
+            self._add(context, response)
+
+        if self._needs_refill(context):
+            self.refill_async([context])
+        return response
+
+    def _needs_refill(self, context):
+        if self.available(context) < self.size:
+            return True
+        if self.rotate_interval is None:
+            return False
+        with self._lock:
+            last = self._refilled.get(context, self._started)
+        return time.monotonic() - last >= self.rotate_interval
+
+    def _add(self, context, response):
+        with self._lock:
+            variants = self._pools.setdefault(context, [])
+            variants.append(response)
+            del variants[:-self.size]   # Drop the oldest variants beyond the pool size
+
+    def fill(self, contexts):
+        """
+        Generates variants until every context has a full pool, then saves the pools to disk.
+        """
+        for context in contexts:
+            while self.available(context) < self.size:
+                self._add(context, self._generate(context))
+        self.save()
+
+    def refill_async(self, contexts):
+        """
+        Queues the contexts for the background worker, which tops up empty slots or replaces the oldest variant.
+        """
+        with self._lock:
+            for context in contexts:
+                if context not in self._pending:
+                    self._pending.add(context)
+                    self._refilled[context] = time.monotonic()
+                    self._queue.put(context)
+
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="response-pool-refill", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            context = self._queue.get()
+            try:
+                # Fill the empty slots, or replace the oldest variant of a full pool
+                for _ in range(max(1, self.size - self.available(context))):
+                    self._add(context, self._generate(context))
+            except Exception:
+                logging.exception(f"Failed to refill response pool for {context!r}")
+            finally:
+                with self._lock:
+                    self._pending.discard(context)
+
+            if self._queue.empty():
+                self.save()
+
+
+# Pre-generate the pools offline, e.g. while building the deployment image:
+#   python response_pool.py --size 16
+if __name__ == "__main__":
+    import argparse
+
+    from chatbot_logic import fixed_contexts, response_pool
+
+    parser = argparse.ArgumentParser(description="Pre-generate chatbot responses for the fixed contexts.")
+    parser.add_argument("--size", type=int, default=response_pool.size, help="number of variants per context")
+    args = parser.parse_args()
+
+    response_pool.size = args.size
+    response_pool.fill(fixed_contexts.values())
+    print(f"Saved {args.size} responses for {len(fixed_contexts)} contexts to {response_pool.path}")